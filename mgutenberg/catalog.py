@@ -0,0 +1,335 @@
+"""
+Offline Project Gutenberg catalog.
+
+The catalog is built once from the Project Gutenberg RDF catalog dump
+(catalog.rdf, optionally gzip or bzip2 compressed), and stored as a
+compact index file.
+
+Routines
+--------
+
+- build_catalog(dump_file_name, index_file_name)
+
+  Parse the RDF dump and write an index file. Returns the number of etexts.
+
+- Catalog(index_file_name)
+
+  Offline catalog, answering `search` and `etext_info` with the same
+  return values as the corresponding routines in `gutenbergweb`.
+
+"""
+import os as _os
+import re as _re
+import gzip as _gzip
+import bz2 as _bz2
+import bisect as _bisect
+import threading as _threading
+import cPickle as _pickle
+from array import array as _array
+import xml.etree.ElementTree as _etree
+from gettext import gettext as _
+
+from util import atomic_write
+from gutenbergweb import _parse_gutenberg_authors
+
+PAGE_SIZE = 100
+
+_RDF = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+_DC = "{http://purl.org/dc/elements/1.1/}"
+_DCTERMS = "{http://purl.org/dc/terms/}"
+_PGTERMS = "{http://www.gutenberg.org/rdfterms/}"
+
+_LANGUAGES = {
+    'en': u'English', 'de': u'German', 'fr': u'French', 'fi': u'Finnish',
+    'nl': u'Dutch', 'it': u'Italian', 'es': u'Spanish', 'pt': u'Portuguese',
+    'sv': u'Swedish', 'da': u'Danish', 'no': u'Norwegian', 'la': u'Latin',
+    'el': u'Greek', 'zh': u'Chinese', 'ru': u'Russian', 'pl': u'Polish',
+    'hu': u'Hungarian', 'eo': u'Esperanto', 'tl': u'Tagalog',
+    'ja': u'Japanese',
+}
+
+_FORMATS = {
+    'text/plain': u'plain text',
+    'text/html': u'HTML',
+    'text/xml': u'XML',
+    'application/pdf': u'PDF',
+    'application/rtf': u'RTF',
+    'application/msword': u'MS Word',
+    'application/prs.plucker': u'plucker',
+    'application/x-mobipocket-ebook': u'Mobipocket',
+    'application/epub+zip': u'EPUB',
+    'audio/mpeg': u'MP3 audio',
+    'audio/ogg': u'Ogg Vorbis audio',
+}
+
+_COMPRESSIONS = {
+    'application/zip': u'zipped',
+    'application/x-gzip': u'gzipped',
+    'application/x-bzip2': u'bzip2 compressed',
+}
+
+_WORD_RE = _re.compile(r'\w+', _re.U)
+
+def _tokenize(text):
+    if not text:
+        return []
+    return _WORD_RE.findall(unicode(text).lower())
+
+#------------------------------------------------------------------------------
+# Interface
+#------------------------------------------------------------------------------
+
+class Catalog(object):
+    """
+    Offline catalog backed by an index file built with `build_catalog`.
+
+    The index is loaded on first use.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._data = None
+        self._lock = _threading.Lock()
+
+    def search(self, author=None, title=None, etextnr=None, subject=None,
+               pageno=0):
+        """
+        Search for an etext
+
+        :Returns:
+            [(etext_id, authors, title, language, category), ...]
+
+            authors = [(name, real_name, date, role), ...]
+        """
+        data = self._get_data()
+        records = data['records']
+
+        if etextnr:
+            try:
+                j = data['etext_map'].get(int(etextnr))
+            except ValueError:
+                j = None
+            if j is None:
+                return []
+            hits = set([j])
+        else:
+            hits = None
+
+        for field, query in (('author', author), ('title', title),
+                             ('subject', subject)):
+            for word in _tokenize(query):
+                found = self._lookup(data[field], word)
+                if hits is None:
+                    hits = found
+                else:
+                    hits &= found
+                if not hits:
+                    return []
+
+        if hits is None:
+            hits = xrange(len(records))
+        hits = sorted(hits)
+
+        start = pageno * PAGE_SIZE
+        return [records[j][:5] for j in hits[start:start + PAGE_SIZE]]
+
+    def etext_info(self, etext_id):
+        """
+        Get info concerning an etext
+
+        :Returns:
+            [(url, description), ...], infodict
+        """
+        data = self._get_data()
+        j = data['etext_map'].get(etext_id)
+        if j is None:
+            return [], dict(category=u'')
+        record = data['records'][j]
+        category = record[4] or _(u'Text')
+        return list(record[5]), dict(category=category)
+
+    def _lookup(self, index, word):
+        """
+        Return the set of records containing a token starting with `word`
+        """
+        vocabulary, postings = index
+        found = set()
+        k = _bisect.bisect_left(vocabulary, word)
+        while k < len(vocabulary) and vocabulary[k].startswith(word):
+            found.update(postings[k])
+            k += 1
+        return found
+
+    def _get_data(self):
+        self._lock.acquire()
+        try:
+            if self._data is None:
+                f = open(self.file_name, 'rb')
+                try:
+                    self._data = _pickle.load(f)
+                finally:
+                    f.close()
+            return self._data
+        finally:
+            self._lock.release()
+
+def build_catalog(dump_file_name, index_file_name):
+    """
+    Parse a Project Gutenberg RDF catalog dump, and write an index file
+
+    :Returns:
+        Number of etexts in the catalog
+    """
+    basefn, ext = _os.path.splitext(dump_file_name)
+    if ext == '.gz':
+        f = _gzip.open(dump_file_name, 'rb')
+    elif ext == '.bz2':
+        f = _bz2.BZ2File(dump_file_name, 'rb')
+    else:
+        f = open(dump_file_name, 'rb')
+
+    try:
+        data = _build_index(_parse_rdf(f))
+    finally:
+        f.close()
+
+    atomic_write(index_file_name,
+                 _pickle.dumps(data, _pickle.HIGHEST_PROTOCOL))
+    return len(data['records'])
+
+#------------------------------------------------------------------------------
+# Index building
+#------------------------------------------------------------------------------
+
+def _build_index(records):
+    """
+    Build the index data structure from parsed records
+
+    Records are sorted by title; each field index is a pair of
+    (sorted token list, postings) where postings are arrays of record
+    numbers.
+    """
+    records.sort(key=lambda r: (r[2].lower(), r[0]))
+
+    data = dict(records=records,
+                etext_map=dict((r[0], j) for j, r in enumerate(records)))
+
+    for field in ('author', 'title', 'subject'):
+        tokens = {}
+        for j, r in enumerate(records):
+            if field == 'author':
+                text = u" ".join([u" ".join(a[:2]) for a in r[1]])
+            elif field == 'title':
+                text = r[2]
+            else:
+                text = r[6]
+            for token in set(_tokenize(text)):
+                tokens.setdefault(token, []).append(j)
+        vocabulary = sorted(tokens.keys())
+        postings = [_array('i', tokens[t]) for t in vocabulary]
+        data[field] = (vocabulary, postings)
+
+    return data
+
+def _texts(el):
+    """
+    Non-empty text content of an element and its descendants
+    """
+    return [unicode(e.text.strip()) for e in el.getiterator()
+            if e.text and e.text.strip()]
+
+def _parse_rdf(f):
+    """
+    Parse an RDF catalog dump
+
+    :Returns:
+        [(etext_id, authors, title, language, category, files, subjects), ...]
+
+        files = [(url, description), ...]
+    """
+    etexts = []
+    files = {}
+
+    root = None
+    for event, el in _etree.iterparse(f, ('start', 'end')):
+        if root is None:
+            root = el
+        if event != 'end':
+            continue
+
+        if el.tag == _PGTERMS + 'etext':
+            etext = _parse_rdf_etext(el)
+            if etext is not None:
+                etexts.append(etext)
+            root.clear()
+        elif el.tag == _PGTERMS + 'file':
+            url = el.get(_RDF + 'about', '')
+            formats = []
+            for fmt in el.findall(_DC + 'format'):
+                formats.extend(_texts(fmt))
+            for ref in el.findall(_DCTERMS + 'isFormatOf'):
+                m = _re.match(r'^#etext(\d+)$', ref.get(_RDF + 'resource', ''))
+                if m and url:
+                    files.setdefault(int(m.group(1)), []).append(
+                        (url, _describe_formats(formats)))
+            root.clear()
+
+    return [(etext_id, authors, title, language, category,
+             files.get(etext_id, []), subjects)
+            for etext_id, authors, title, language, category, subjects
+            in etexts]
+
+def _parse_rdf_etext(el):
+    m = _re.match(r'^etext(\d+)$', el.get(_RDF + 'ID', ''))
+    if not m:
+        return None
+    etext_id = int(m.group(1))
+
+    authors = []
+    for tag, default_role in (('creator', u'author'), ('contributor', u'')):
+        for sel in el.findall(_DC + tag):
+            for text in _texts(sel):
+                for a in _parse_gutenberg_authors(text):
+                    if not a[3] and default_role:
+                        a = a[:3] + (default_role,)
+                    authors.append(a)
+
+    title = u''
+    for sel in el.findall(_DC + 'title'):
+        title = u"\n".join(_texts(sel))
+        break
+
+    languages = []
+    for sel in el.findall(_DC + 'language'):
+        languages.extend([_LANGUAGES.get(x, x) for x in _texts(sel)])
+
+    subjects = []
+    for sel in el.findall(_DC + 'subject'):
+        subjects.extend(_texts(sel))
+
+    category = u''
+    for sel in el.findall(_DC + 'type'):
+        if u'Sound' in _texts(sel):
+            category = _(u'Audio book')
+
+    return (etext_id, authors, title, u", ".join(languages), category,
+            u" ".join(subjects))
+
+def _describe_formats(formats):
+    """
+    Human-readable description of a list of MIME types
+    """
+    kind = []
+    compression = []
+    for fmt in formats:
+        parts = [x.strip() for x in fmt.split(';')]
+        mime = parts[0].lower()
+        if mime in _COMPRESSIONS:
+            compression.append(_COMPRESSIONS[mime])
+            continue
+        kind.append(_FORMATS.get(mime, mime))
+        for p in parts[1:]:
+            m = _re.match(r'^charset="?([^"]+)"?$', p)
+            if m:
+                kind.append(m.group(1).lower())
+    return u" ".join(kind + compression)
@@ -3,7 +3,8 @@ GUI threading helpers
 """
 import threading
 import time
-import Queue
+import heapq
+import traceback
 
 try:
     import glib
@@ -12,7 +13,8 @@ except ImportError:
 
 __all__ = ['run_in_gui_thread', 'run_later_in_gui_thread',
            'assert_gui_thread', 'start_thread', 'run_in_background',
-           'SingleRunner']
+           'SingleRunner', 'WorkerPool', 'PRIORITY_INTERACTIVE',
+           'PRIORITY_NORMAL', 'PRIORITY_BACKGROUND']
 
 def run_in_gui_thread(func, *a, **kw):
     """Run the function in the GUI thread next time when the GUI is idle."""
@@ -40,24 +42,164 @@ def assert_gui_thread(func):
     _wrapper.__name__ = func.__name__
     return _wrapper
 
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BACKGROUND = 20
+
+class Task(object):
+    """
+    Handle to a function queued in a WorkerPool.
+    """
+
+    def __init__(self, func, a, kw, callback):
+        self.func = func
+        self.a = a
+        self.kw = kw
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the task: if it has not started yet, it is not run, and
+        its callback will not be called.
+        """
+        self.cancelled = True
+
+    def _run(self):
+        if self.cancelled:
+            return
+        if self.callback is None:
+            try:
+                self.func(*self.a, **self.kw)
+            except Exception:
+                traceback.print_exc()
+            return
+        try:
+            result = self.func(*self.a, **self.kw)
+        except Exception, e:
+            result = e
+        if not self.cancelled:
+            run_in_gui_thread(self._finish, result)
+
+    def _finish(self, result):
+        # cancel() is called from the GUI thread, so checking here
+        # guarantees that no callback happens after it
+        if not self.cancelled:
+            self.callback(result)
+
+class WorkerPool(object):
+    """
+    Run functions in a bounded set of worker threads.
+
+    Queued functions are run in order of priority (lower first), and
+    then in order of submission. At most `max_workers` - 1 functions
+    with lower priority than PRIORITY_INTERACTIVE run at the same time,
+    so that long downloads do not hold up interactive work. Workers are
+    started on demand, and exit after being idle for `idle_timeout`
+    seconds.
+    """
+
+    def __init__(self, max_workers=3, idle_timeout=5.0):
+        self.max_workers = max_workers
+        self.max_background = max(1, max_workers - 1)
+        self.idle_timeout = idle_timeout
+        self._queue = []
+        self._seq = 0
+        self._workers = 0
+        self._idle = 0
+        self._background = 0
+        self._cond = threading.Condition()
+
+    def submit(self, func, a=(), kw={}, callback=None,
+               priority=PRIORITY_NORMAL):
+        """
+        Queue func(*a, **kw) for running.
+
+        If `callback` is given, it is called in the GUI thread with the
+        return value or the raised exception.
+
+        :Returns:
+            Task handle, whose ``cancel()`` method cancels the task.
+        """
+        task = Task(func, a, kw, callback)
+        self._cond.acquire()
+        try:
+            self._seq += 1
+            heapq.heappush(self._queue, (priority, self._seq, task))
+            if (len(self._queue) > self._idle
+                    and self._workers < self.max_workers):
+                self._workers += 1
+                threading.Thread(target=self._worker).start()
+            else:
+                self._cond.notify()
+        finally:
+            self._cond.release()
+        return task
+
+    def _runnable(self):
+        if not self._queue:
+            return False
+        priority = self._queue[0][0]
+        return (priority <= PRIORITY_INTERACTIVE
+                or self._background < self.max_background)
+
+    def _worker(self):
+        while True:
+            self._cond.acquire()
+            try:
+                if not self._runnable():
+                    self._idle += 1
+                    self._cond.wait(self.idle_timeout)
+                    self._idle -= 1
+                if not self._runnable():
+                    # queued background tasks are picked up by the
+                    # workers running the others when they finish
+                    self._workers -= 1
+                    return
+                priority, seq, task = heapq.heappop(self._queue)
+                background = (priority > PRIORITY_INTERACTIVE)
+                if background:
+                    self._background += 1
+            finally:
+                self._cond.release()
+            try:
+                task._run()
+            finally:
+                if background:
+                    self._cond.acquire()
+                    try:
+                        self._background -= 1
+                        self._cond.notify()
+                    finally:
+                        self._cond.release()
+
+_pool = WorkerPool()
+
 def start_thread(func, *a):
-    threading.Thread(target=func, args=a).start()
+    """
+    Run func in a worker thread, ahead of background work.
+
+    :Returns:
+        Task handle.
+    """
+    return _pool.submit(func, a, priority=PRIORITY_INTERACTIVE)
 
 def run_in_background(func, *a, **kw):
     """
     Run func in background and call callback after it completes.
 
     Callback is called with return value or, if exception was raised,
-    the exception as an argument.
+    the exception as an argument. The optional `priority` keyword
+    argument orders queued functions; PRIORITY_INTERACTIVE ones are run
+    before PRIORITY_BACKGROUND ones.
+
+    :Returns:
+        Task handle. Calling its ``cancel()`` method ensures that the
+        callback is not called.
     """
     callback = kw.pop('callback')
-    def runner():
-        try:
-            result = func(*a, **kw)
-        except Exception, e:
-            result = e
-        run_in_gui_thread(callback, result)
-    start_thread(runner)
+    priority = kw.pop('priority', PRIORITY_NORMAL)
+    return _pool.submit(func, a, kw, callback=callback, priority=priority)
 
 class SingleRunner(object):
     """
@@ -15,8 +15,18 @@ Routines
 - etext_info(etext_id)
 
   Returns [(url, format, encoding, compression), ...]
+
+- set_search_cache(cache)
+
+  Cache search results persistently in the given SearchCache
+
+- set_offline_catalog(catalog)
+
+  Answer searches from a local catalog.Catalog instead of the web
 """
 import urllib as _urllib, re as _re
+import time as _time, threading as _threading
+import cPickle as _pickle
 from gettext import gettext as _
 
 from util import *
@@ -27,10 +37,18 @@ from util import *
 
 class SearchFailure(RuntimeError): pass
 
-def search(author=None, title=None, etextnr=None, subject=None, pageno=0):
+def search(author=None, title=None, etextnr=None, subject=None, pageno=0,
+           use_cache=True, cancelled=None):
     """
     Search for an etext in the Project Gutenberg catalog
 
+    If a search cache is set and `use_cache` is True, previously
+    fetched results are returned without network access.
+
+    If `cancelled` is given, it is called after the result page is
+    fetched; if it returns True, the page is not parsed and None is
+    returned.
+
     :Returns:
         [(etext_id, authors, title, language, category), ...]
 
@@ -46,6 +64,20 @@ def search(author=None, title=None, etextnr=None, subject=None, pageno=0):
     if not subject:
         subject = ''
 
+    if _offline_catalog is not None:
+        return _offline_catalog.search(author=author, title=title,
+                                       etextnr=etextnr, subject=subject,
+                                       pageno=pageno)
+
+    key = (unicode(author), unicode(title), unicode(subject),
+           unicode(etextnr), int(pageno))
+
+    cache = _search_cache
+    if cache is not None and use_cache:
+        entries = cache.get(key)
+        if entries is not None:
+            return entries
+
     data = _urllib.urlencode([('author', unicode(author)),
                               ('title', unicode(title)),
                               ('subject', unicode(subject)),
@@ -54,10 +86,17 @@ def search(author=None, title=None, etextnr=None, subject=None, pageno=0):
     url = _SEARCH_URL + '?' + data
     
     output = _fetch_page(url)
+    if cancelled is not None and cancelled():
+        return None
     entries = _parse_gutenberg_search_html(output)
     
     # NB. Gutenberg search sometimes return duplicate entries
-    return unique(entries, key=lambda x: x[0])
+    entries = unique(entries, key=lambda x: x[0])
+
+    if cache is not None:
+        cache.put(key, entries)
+
+    return entries
 
 def etext_info(etext_id):
     """
@@ -69,9 +108,134 @@ def etext_info(etext_id):
         infodict contains information about the whole entry.
         Keys: 'category'
     """
+    if _offline_catalog is not None:
+        return _offline_catalog.etext_info(etext_id)
+
     output = _fetch_page(_ETEXT_URL % dict(etext=etext_id))
     return _parse_gutenberg_ebook_html(etext_id, output)
 
+def set_search_cache(cache):
+    """
+    Use the given SearchCache for search results (None disables caching)
+    """
+    global _search_cache
+    _search_cache = cache
+
+def set_offline_catalog(catalog):
+    """
+    Answer searches from the given catalog.Catalog (None to use the web)
+    """
+    global _offline_catalog
+    _offline_catalog = catalog
+
+#------------------------------------------------------------------------------
+# Search result cache
+#------------------------------------------------------------------------------
+
+_search_cache = None
+_offline_catalog = None
+
+class SearchCache(object):
+    """
+    Persistent on-disk cache of parsed search results.
+
+    Entries expire `ttl` seconds after they were fetched, and at most
+    `max_entries` are kept, least recently used ones being evicted first.
+    Use times are saved with new entries, and at most every
+    `save_interval` seconds otherwise.
+    """
+
+    def __init__(self, file_name, max_entries=256, ttl=3*24*3600,
+                 save_interval=60):
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.save_interval = save_interval
+        self._entries = None
+        self._saved = 0
+        self._lock = _threading.Lock()
+
+    def get(self, key):
+        """
+        Return a copy of the cached entries for the key, or None if there
+        are none
+        """
+        self._lock.acquire()
+        try:
+            self._load()
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            fetched, used, value = item
+            now = _time.time()
+            if now > fetched + self.ttl or now < fetched:
+                del self._entries[key]
+                return None
+            self._entries[key] = (fetched, now, value)
+            if not (self._saved <= now < self._saved + self.save_interval):
+                self._save()
+            return list(value)
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        self._lock.acquire()
+        try:
+            self._load()
+            now = _time.time()
+            self._entries[key] = (now, now, list(value))
+            self._expire(now)
+            self._save()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self._save()
+        finally:
+            self._lock.release()
+
+    def _expire(self, now):
+        for key, (fetched, used, value) in self._entries.items():
+            if now > fetched + self.ttl or now < fetched:
+                del self._entries[key]
+
+        excess = len(self._entries) - self.max_entries
+        if excess > 0:
+            lru = sorted(self._entries.iteritems(), key=lambda x: x[1][1])
+            for key, item in lru[:excess]:
+                del self._entries[key]
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            f = open(self.file_name, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                entries = _pickle.load(f)
+            except Exception:
+                # corrupt cache file; just start afresh
+                return
+        finally:
+            f.close()
+        if isinstance(entries, dict):
+            self._entries = entries
+
+    def _save(self):
+        self._saved = _time.time()
+        try:
+            atomic_write(self.file_name,
+                         _pickle.dumps(self._entries, _pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            # caching is best-effort only
+            pass
+
 #------------------------------------------------------------------------------
 # Helpers
 #------------------------------------------------------------------------------
@@ -110,7 +274,6 @@ _DOWNLOAD_URL_BASE = "http://www.gutenberg.org"
 #-- Search result page
 
 _GUTEN_SEARCH_RE_1 = _re.compile("""
-.*?
 <tr\s+class=".*?">
   \s*
   <td>(?P<etext>.*?)</td>
@@ -140,47 +303,38 @@ def _parse_gutenberg_search_html(html):
     """
     entries = []
 
-    # "Parse" entries
-    h = html
-    while h:
-        m = _GUTEN_SEARCH_RE_1.search(h)
-        if m:
-            h = h[m.end():]
-            g = m.groupdict()
+    # "Parse" entries, in a single pass over the page
+    for m in _GUTEN_SEARCH_RE_1.finditer(html):
+        g = m.groupdict()
 
-            try:
-                etext = int(g['etext'])
-            except (KeyError, ValueError):
-                continue
-
-            if 'stock_volume' in g.get('infocol', ''):
-                category = _(u'Audio book')
-            else:
-                category = u''
-
-            entries.append((
-                etext,
-                _parse_gutenberg_authors(unicode(_strip_tags(g.get('authors', '')), 'utf-8')),
-                unicode(_strip_tags(g.get('title', '')), 'utf-8'),
-                unicode(_strip_tags(g.get('language', '')), 'utf-8'),
-                category,
-                ))
+        try:
+            etext = int(g['etext'])
+        except (KeyError, ValueError):
+            continue
+
+        if 'stock_volume' in g.get('infocol', ''):
+            category = _(u'Audio book')
         else:
-            break
+            category = u''
+
+        entries.append((
+            etext,
+            _parse_gutenberg_authors(unicode(_strip_tags(g.get('authors', '')), 'utf-8')),
+            unicode(_strip_tags(g.get('title', '')), 'utf-8'),
+            unicode(_strip_tags(g.get('language', '')), 'utf-8'),
+            category,
+            ))
 
     return entries
 
 #-- Ebook info page
 
-_GUTEN_ETEXT_RE_0 = _re.compile("""
-<td[^>]*dcterms:type[^>]*>(?P<category>.*?)</td>
-""", _re.X | _re.I)
-
-_GUTEN_ETEXT_RE_1 = _re.compile('''
-.*?
+_GUTEN_ETEXT_RE = _re.compile('''
+  <td[^>]*dcterms:type[^>]*>(?P<category>.*?)</td>
+|
   <td[^>]*dcterms:format[^>]*>
     \s*
-    <a.*\s+href="(?P<url>[^"]*)"[^>]*>(?P<description>[^>]*)</a>
+    <a\s[^>]*?href="(?P<url>[^"]*)"[^>]*>(?P<description>[^>]*)</a>
 ''', _re.X | _re.I)
 
 def _parse_gutenberg_ebook_html(etext, html):
@@ -195,32 +349,27 @@ def _parse_gutenberg_ebook_html(etext, html):
             'plucker'
             ))
 
-    category = u''
-    
-    h = html
+    category = None
 
-    m = _GUTEN_ETEXT_RE_0.search(h)
-    if m:
-        g = m.groupdict()
-        category = unicode(_strip_tags(g.get('category', '').strip()),
-                           'utf-8')
+    # Category and download links, in a single pass over the page
+    for m in _GUTEN_ETEXT_RE.finditer(html):
+        if m.group('category') is not None:
+            if category is None:
+                category = unicode(_strip_tags(m.group('category').strip()),
+                                   'utf-8')
+            continue
 
-    while h:
-        m = _GUTEN_ETEXT_RE_1.search(h)
-        if m:
-            h = h[m.end():]
-            g = m.groupdict()
+        url = m.group('url').strip()
+        description = unicode(_strip_tags(m.group('description')).strip(),
+                              'utf-8')
 
-            url = g.get('url', '').strip()
-            description = unicode(_strip_tags(g.get('description', '')).strip(),
-                             'utf-8')
+        if url:
+            if url.startswith('/'):
+                url = _DOWNLOAD_URL_BASE + url
+            entries.append((url, description))
 
-            if url:
-                if url.startswith('/'):
-                    url = _DOWNLOAD_URL_BASE + url
-                entries.append((url, description))
-        else:
-            break
+    if category is None:
+        category = u''
 
     return entries, dict(category=category)
 
@@ -7,7 +7,10 @@ import math
 
 from ui import *
 from model import *
+import gutenbergweb
+import catalog
 import reader
+import model_text
 
 CONFIG_SCHEMA = {
     'search_dirs': (list, str),
@@ -17,12 +20,24 @@ CONFIG_SCHEMA = {
     'portrait': bool,
     'ui_page': int,
     'recent_files': (dict, int),
+    'prefetch_pages': int,
+    'watch_books': bool,
 }
 
 def main():
     p = optparse.OptionParser()
+    p.add_option("--import-catalog", action="store", dest="import_catalog",
+                 metavar="FILE", default=None,
+                 help="build offline catalog from a Project Gutenberg "
+                      "RDF catalog dump, and exit")
     options, args = p.parse_args()
 
+    catalog_file = cache_file_name('catalog')
+    if options.import_catalog:
+        n = catalog.build_catalog(options.import_catalog, catalog_file)
+        print "Imported %d etexts" % n
+        return
+
     # Config & defaults
     config = Config(CONFIG_SCHEMA)
     try:
@@ -41,6 +56,15 @@ def main():
     config.setdefault('inverse_colors', False)
     config.setdefault('portrait', False)
     config.setdefault('ui_page', 1)
+    config.setdefault('prefetch_pages', 0)
+    config.setdefault('watch_books', True)
+
+    # Caches
+    gutenbergweb.set_search_cache(
+        gutenbergweb.SearchCache(cache_file_name('search_cache')))
+    if os.path.isfile(catalog_file):
+        gutenbergweb.set_offline_catalog(catalog.Catalog(catalog_file))
+    model_text.set_book_cache(model_text.BookCache(cache_file_name('books')))
 
     # Run
     app = MGutenbergApp(config)
@@ -55,7 +79,8 @@ class MGutenbergApp(AppBase):
         
         self.config = config
         self.ebook_list = EbookList(config['search_dirs'],
-                                    config['recent_files'])
+                                    config['recent_files'],
+                                    cache_file_name('library_index'))
         self.window = MainWindow(self)
         self.readers = []
 
@@ -94,6 +119,8 @@ class MGutenbergApp(AppBase):
 
     def start_reader(self, filename):
         self.ebook_list.mark_visited(filename, self.config['recent_files'])
+        self.config.mark_dirty('recent_files', filename)
+        self.config.save_later()
         reader.run(self, filename)
 
     def run(self, args):
@@ -109,13 +136,14 @@ class MGutenbergApp(AppBase):
 
         def done_cb(r):
             end_notify()
-            self.window.ebook_list.thaw()
             if isinstance(r, Exception):
                 self.app.error_message(_("Error refreshing book list"), r)
+            elif self.config['watch_books']:
+                self.ebook_list.start_watching()
 
+        # Books are shown as they are found, so the view is not frozen
         end_notify = self.show_notify(self.window.widget,
                                       _("Looking for books..."))
-        self.window.ebook_list.freeze()
         self.ebook_list.refresh(callback=done_cb)
 
         # Start
@@ -124,6 +152,7 @@ class MGutenbergApp(AppBase):
         gtk.main()
 
     def quit(self):
+        self.ebook_list.stop_watching()
         self.config.save()
         gtk.main_quit()
 
@@ -406,6 +435,9 @@ class EbookListWidget(object):
     def __init__(self, app, store=None):
         self.app = app
         self.filter_text = ''
+        self._matches = None
+        self._matches_text = None
+        self._matches_generation = None
 
         if store is None:
             self.store = app.ebook_list
@@ -525,13 +557,16 @@ class EbookListWidget(object):
                 model = model.get_model()
             if model != self.store:
                 raise RuntimeError("Programming error -- please report")
-            it = model.get_iter(pth)
+            file_name = model[pth][3]
 
             self._active_item = None
 
             def response(widget, response_id):
                 if response_id == gtk.RESPONSE_OK:
-                    model.delete_file(it)
+                    # the list may have changed while the dialog was open
+                    it = model.get_file_iter(file_name)
+                    if it is not None:
+                        model.delete_file(it)
                 dlg.destroy()
             dlg = confirm_dialog(parent=self.app.window.widget,
                                  text=_("Delete file?"),
@@ -548,6 +583,7 @@ class EbookListWidget(object):
             model = model.get_model()
         if model != self.store:
             raise RuntimeError("Programming error -- please report")
+        file_names = [self.store[r][3] for r in rows]
 
         dlg = confirm_dialog(parent=self.app.window.widget,
                              text=_("Delete files?"))
@@ -581,11 +617,10 @@ class EbookListWidget(object):
 
         def response(widget, response_id):
             if response_id == gtk.RESPONSE_OK:
-                rows_sorted = [r[0] for r in rows]
-                rows_sorted.sort(key=lambda x: -x)
-                for row in rows_sorted:
-                    it = self.store.get_iter((row,))
-                    self.store.delete_file(it)
+                for file_name in file_names:
+                    it = self.store.get_file_iter(file_name)
+                    if it is not None:
+                        self.store.delete_file(it)
             dlg.destroy()
 
         dlg.connect("response", response)
@@ -612,11 +647,12 @@ class EbookListWidget(object):
                     self.filtered_store = gtk.TreeModelSort(self.filter)
                     self.filter.set_visible_func(self.filter_func)
                 
+                self._update_matches()
                 self.filter.refilter()
                 if self.widget_tree.get_model() is not self.filtered_store:
                     self.widget_tree.set_model(self.filtered_store)
 
-        self.filter_text = text.lower().strip().split()
+        self.filter_text = fold_text(text).split()
 
         delay = 1000 if MAEMO else 500
         if now:
@@ -644,14 +680,37 @@ class EbookListWidget(object):
                     self.filter_entry.grab_focus()
                     self.filter_entry.set_position(-1)
 
+    def _update_matches(self):
+        """
+        Find the file names of the books matching the filter text
+        """
+        ebook_list = self.app.ebook_list
+        terms = self.filter_text
+
+        old_terms = self._matches_text
+        if (self._matches is not None
+                and self._matches_generation == ebook_list.generation
+                and all(any(y in x for x in terms) for y in old_terms)):
+            # Query narrows the previous one: only its matches can match
+            candidates = self._matches
+        else:
+            candidates = None
+
+        self._matches = ebook_list.search_index.search(terms, candidates)
+        self._matches_text = terms
+        self._matches_generation = ebook_list.generation
+
     def filter_func(self, model, it, data=None):
         if not self.filter_text: return True
-        entry = model[it]
-        try:
-            raw = ''.join([entry[0], entry[1], entry[2]]).lower()
-        except TypeError:
-            return True
-        return all(x in raw for x in self.filter_text)
+        file_name = model.get_value(it, 3)
+        ebook_list = self.app.ebook_list
+        if (self._matches is not None
+                and self._matches_text == self.filter_text
+                and self._matches_generation == ebook_list.generation):
+            return file_name in self._matches
+
+        # Books added after the matches were computed
+        return ebook_list.search_index.matches(file_name, self.filter_text)
 
     # ---
 
@@ -737,20 +796,34 @@ class EbookListWidget(object):
 class GutenbergSearchWidget(object):
     def __init__(self, app):
         self.app = app
-        self.results = GutenbergSearchList()
+        self.results = GutenbergSearchList(
+            prefetch_pages=app.config['prefetch_pages'])
+        self._search_notify_cb = None
         self._construct()
 
         self.search_button.connect("clicked", self.on_search_clicked)
         self.widget_tree.connect("row-activated", self.on_activated)
 
+    def _start_search_notify(self):
+        # A new search supersedes the previous one, whose callback
+        # will never be called
+        self._end_search_notify()
+        self._search_notify_cb = self.app.show_notify(self.widget,
+                                                      _("Searching..."))
+
+    def _end_search_notify(self):
+        if self._search_notify_cb is not None:
+            self._search_notify_cb()
+            self._search_notify_cb = None
+
     def on_search_clicked(self, btn):
         def done_cb(r):
-            notify_cb()
+            self._end_search_notify()
             self.widget_tree.columns_autosize()
             if isinstance(r, Exception):
                 self.app.error_message(_("Error in fetching search results"),
                                        r)
-        notify_cb = self.app.show_notify(self.widget, _("Searching..."))
+        self._start_search_notify()
         self.results.new_search(
             author=self.search_author.get_text(),
             title=self.search_title.get_text(),
@@ -765,7 +838,7 @@ class GutenbergSearchWidget(object):
             pos[0] = self.widget_tree.get_vadjustment().get_value()
 
         def done_cb(r):
-            notify_cb()
+            self._end_search_notify()
             if pos is not None:
                 self.widget_tree.get_vadjustment().set_value(pos[0])
             if isinstance(r, Exception):
@@ -773,7 +846,7 @@ class GutenbergSearchWidget(object):
                                        r)
 
         if entry[4] == NEXT_ID:
-            notify_cb = self.app.show_notify(self.widget, _("Searching..."))
+            self._start_search_notify()
             self.results.next_page(callback=done_cb, pre_callback=pre_cb)
             return
         else:
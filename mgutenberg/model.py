@@ -5,6 +5,10 @@ EbookList
 
     List of all Ebooks stored on the system
 
+SearchIndex
+
+    Accent- and case-insensitive text index over EbookList rows
+
 GutenbergSearchList
 
     Result of a Project Gutenberg search
@@ -19,7 +23,11 @@ Config
 
 """
 
-import re, os, sys, shutil, tempfile, time
+import re, os, sys, shutil, tempfile, time, stat, threading, Queue, bisect
+import random
+import unicodedata
+import traceback, marshal, struct, zlib
+import cPickle as pickle
 import xml.etree.ElementTree as ET
 from xml.parsers.expat import ExpatError
 
@@ -30,6 +38,19 @@ from gettext import gettext as _
 from guithread import *
 from util import *
 
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 class OverwriteFileException(Exception): pass
 
 
@@ -45,37 +66,78 @@ def _is_caps_case(x):
     else:
         return x[0] == x[0].upper() and x[1] == x[1].lower()
 
+VALID_EXTENSIONS = frozenset([
+    '.txt',
+    '.html', '.htm',
+    '.fb2',
+    '.chm',
+    '.rtf',
+    '.oeb',
+    '.zip',
+    '.prc', '.pdb', '.mobi',
+    '.orb',
+    '.opf', '.oebzip',
+    '.tcr',
+    '.tgz', '.ipk',
+])
+
+SKIP_EXTENSIONS = frozenset(['.gz', '.bz2', '.tar', '.utf8', '.ascii', '.gen'])
+
 def get_valid_basename(base):
-    valid_ext = ['.txt',
-                 '.html', '.htm',
-                 '.fb2',
-                 '.chm',
-                 '.rtf',
-                 '.oeb',
-                 '.zip',
-                 '.prc', '.pdb', '.mobi',
-                 '.orb',
-                 '.opf', '.oebzip',
-                 '.tcr',
-                 '.tgz', '.ipk',
-                 ]
-    skip_ext = ['.gz', '.bz2', '.tar', '.utf8', '.ascii', '.gen']
+    """
+    Strip the book extensions from a file name
 
+    :Returns:
+        The file name without extensions, or None if it is not a book file.
+    """
     while True:
-        base, ext = os.path.splitext(base)
-        if ext in valid_ext:
+        # As os.path.splitext, for file names without a directory part
+        j = base.rfind('.')
+        if j <= 0 or not base[:j].strip('.'):
+            return None
+        ext = base[j:]
+        base = base[:j]
+        if ext in VALID_EXTENSIONS:
             return base
-        elif ext in skip_ext:
-            pass
-        else:
+        elif ext not in SKIP_EXTENSIONS:
             return None
 
-FILE_RES = [
-    re.compile(r"^(?P<auth>[^-\[\]]+) - (?P<titl>[^\[\]]+) \[(?P<lang>.*)\]$"),
-    re.compile(r"^(?P<auth>[^-]+) - (?P<titl>.+)$"),
-    re.compile(r"^(?P<titl>[^\[\]]+) \[(?P<lang>.+)\]$"),
-    re.compile(r"^(?P<titl>.+)$")
-]
+# Book file name patterns, in order of preference:
+# "Author - Title [lang]", "Author - Title", "Title [lang]", "Title"
+FILE_RE = re.compile(
+    r"^(?:"
+    r"(?P<auth_titl_lang>(?P<auth1>[^-\[\]]+) - (?P<titl1>[^\[\]]+) "
+    r"\[(?P<lang1>.*)\])"
+    r"|(?P<auth_titl>(?P<auth2>[^-]+) - (?P<titl2>.+))"
+    r"|(?P<titl_lang>(?P<titl3>[^\[\]]+) \[(?P<lang3>.+)\])"
+    r"|(?P<titl>.+)"
+    r")$")
+
+# Groups holding the author, title and language for each pattern
+_FILE_RE_GROUPS = {
+    'auth_titl_lang': ('auth1', 'titl1', 'lang1'),
+    'auth_titl': ('auth2', 'titl2', 'lang1'),
+    'titl_lang': ('auth1', 'titl3', 'lang3'),
+    'titl': ('auth1', 'titl', 'lang1'),
+}
+
+def classify_file_name(path):
+    """
+    Split a book file name into its parts
+
+    :Returns:
+        (author, title, language), or None if the file is not a book.
+        `author` is None if the file name does not contain it.
+    """
+    base = get_valid_basename(path)
+    if base is None:
+        return None
+
+    m = FILE_RE.match(base)
+    if m is None:
+        return (None, base, '')
+    author, title, lang = m.group(*_FILE_RE_GROUPS[m.lastgroup])
+    return (author, title, lang or '')
 
 LANGUAGE_CODE_MAP = {
     'english': 'en',
@@ -83,20 +145,503 @@ LANGUAGE_CODE_MAP = {
     'finnish': 'fi',
 }
 
+def parse_book_file_name(path, full_path, author_name=""):
+    """
+    Parse author, title and language from a book file name
+
+    :Returns:
+        (author, title, language, full_path), or None if the file is not
+        a book.
+    """
+    parts = classify_file_name(path)
+    if parts is None:
+        return None
+
+    author, title, lang = parts
+    if author is None:
+        author = author_name
+    return (author.replace("; ", "\n"), title.replace("; ", "\n"), lang,
+            full_path)
+
+def _list_dir(d):
+    """
+    List directory contents
+
+    Uses directory entry types from scandir, if available, to avoid
+    a stat call per entry.
+
+    :Returns:
+        ([file names], [subdirectory names])
+    """
+    files = []
+    subdirs = []
+    if _scandir is not None:
+        for entry in _scandir(d):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for path in os.listdir(d):
+            if os.path.isdir(os.path.join(d, path)):
+                subdirs.append(path)
+            else:
+                files.append(path)
+    return files, subdirs
+
+class LibraryIndex(object):
+    """
+    Persistent index of the books in a directory tree.
+
+    For each directory, the index records its modification time and the
+    books and subdirectories in it. On rescan, only directories whose
+    modification time has changed are listed again.
+
+    Directories are scanned in parallel by `n_threads` threads.
+    """
+
+    # Directories modified this recently (in seconds) are always rescanned;
+    # VFAT timestamps have a 2 second resolution
+    MTIME_SLACK = 2
+
+    def __init__(self, file_name=None, n_threads=4):
+        self.file_name = file_name
+        self.n_threads = n_threads
+        self._dirs = None
+        self._lock = threading.Lock()
+
+    def scan(self, search_dirs, callback=None):
+        """
+        Find books under the given directories
+
+        If `callback` is given, it is called (in a scanning thread) with
+        the list of books found in each directory as the scan progresses.
+
+        :Returns:
+            [(author, title, language, file_name), ...], in no
+            particular order
+        """
+        self._lock.acquire()
+        try:
+            return self._scan(search_dirs, callback)
+        finally:
+            self._lock.release()
+
+    def rescan(self, dirs):
+        """
+        Rescan directories whose contents have changed
+
+        Only the given directories are listed again. Subdirectories
+        that are new in them are scanned, and the books under ones that
+        were removed are dropped. Directories not in the index are
+        skipped: new ones are found through their parents.
+
+        :Returns:
+            removed, added
+
+            removed = added = [(author, title, language, file_name), ...]
+        """
+        self._lock.acquire()
+        try:
+            return self._rescan(dirs)
+        finally:
+            self._lock.release()
+
+    def _scan(self, search_dirs, callback):
+        if self._dirs is None:
+            self._dirs = self._load()
+
+        old_dirs = self._dirs
+        # Keys are normalized, as are the paths of inotify events
+        roots = [(os.path.abspath(d), "") for d in search_dirs]
+        new_dirs, files = self._walk(roots, old_dirs, callback)
+        self._dirs = new_dirs
+        if new_dirs != old_dirs:
+            self._save()
+        return files
+
+    def _rescan(self, dirs):
+        if self._dirs is None:
+            self._dirs = self._load()
+
+        old_entries = []
+        new_entries = []
+        roots = []
+        changed = False
+
+        # Parents first, so that directories removed with their parent
+        # are skipped
+        for d in sorted(set([os.path.abspath(d) for d in dirs])):
+            item = self._dirs.get(d)
+            if item is None:
+                continue
+            author_name, entries, subdirs = item[1:]
+            changed = True
+
+            listing = None
+            try:
+                st = os.stat(d)
+                if stat.S_ISDIR(st.st_mode):
+                    listing = self._list_books(d, author_name)
+            except OSError:
+                pass
+            if listing is None:
+                old_entries.extend(self._drop_tree(d))
+                continue
+
+            dir_entries, dir_subdirs = listing
+            self._dirs[d] = (self._dir_mtime(st), author_name, dir_entries,
+                             dir_subdirs)
+            old_entries.extend(entries)
+            new_entries.extend(dir_entries)
+
+            subdirs = set(subdirs)
+            dir_subdirs = set(dir_subdirs)
+            for path in subdirs - dir_subdirs:
+                old_entries.extend(self._drop_tree(os.path.join(d, path)))
+            for path in dir_subdirs - subdirs:
+                roots.append((os.path.join(d, path),
+                              _sub_author(author_name, path)))
+
+        if roots:
+            new_dirs, files = self._walk(roots, self._dirs)
+            self._dirs.update(new_dirs)
+            new_entries.extend(files)
+
+        if changed:
+            self._save()
+        old_entries = set(old_entries)
+        new_entries = set(new_entries)
+        return list(old_entries - new_entries), list(new_entries - old_entries)
+
+    def _drop_tree(self, d):
+        """
+        Remove a directory and its subdirectories from the index
+
+        :Returns:
+            the books that were in them
+        """
+        entries = []
+        stack = [d]
+        while stack:
+            d = stack.pop()
+            item = self._dirs.pop(d, None)
+            if item is not None:
+                entries.extend(item[2])
+                stack.extend([os.path.join(d, path) for path in item[3]])
+        return entries
+
+    def _walk(self, roots, old_dirs, callback=None):
+        """
+        Scan the trees under the given (directory, author name) pairs
+
+        :Returns:
+            new_dirs, files
+        """
+        new_dirs = {}
+        files = []
+
+        queue = Queue.Queue()
+        for item in roots:
+            queue.put(item)
+
+        def worker():
+            while True:
+                item = queue.get()
+                try:
+                    if item is None:
+                        return
+                    self._scan_dir(item[0], item[1], old_dirs, new_dirs,
+                                   files, queue, callback)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    queue.task_done()
+
+        threads = [threading.Thread(target=worker)
+                   for j in xrange(self.n_threads)]
+        for t in threads:
+            t.start()
+        queue.join()
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        return new_dirs, files
+
+    def _scan_dir(self, d, author_name, old_dirs, new_dirs, files, queue,
+                  callback):
+        try:
+            st = os.stat(d)
+        except OSError:
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            return
+
+        item = old_dirs.get(d)
+        if (item is not None and item[0] == st.st_mtime
+                and item[1] == author_name):
+            entries, subdirs = item[2], item[3]
+        else:
+            listing = self._list_books(d, author_name)
+            if listing is None:
+                return
+            entries, subdirs = listing
+
+        new_dirs[d] = (self._dir_mtime(st), author_name, entries, subdirs)
+        files.extend(entries)
+        if callback is not None and entries:
+            callback(entries)
+
+        for path in subdirs:
+            # recurse into a directory
+            queue.put((os.path.join(d, path), _sub_author(author_name, path)))
+
+    def _list_books(self, d, author_name):
+        """
+        List the books and subdirectories in a directory
+
+        :Returns:
+            ([entries], [subdirectory names]), or None if it cannot be
+            listed
+        """
+        try:
+            paths, subdirs = _list_dir(d)
+        except OSError:
+            # permission error, etc.
+            return None
+
+        entries = []
+        for path in paths:
+            entry = parse_book_file_name(path, os.path.join(d, path),
+                                         author_name)
+            if entry is not None:
+                entries.append(entry)
+        return entries, subdirs
+
+    def _dir_mtime(self, st):
+        mtime = st.st_mtime
+        if time.time() - mtime < self.MTIME_SLACK:
+            return None
+        return mtime
+
+    def _load(self):
+        if self.file_name is None:
+            return {}
+        try:
+            f = open(self.file_name, 'rb')
+        except IOError:
+            return {}
+        try:
+            try:
+                dirs = pickle.load(f)
+            except Exception:
+                # corrupt index; rebuild it
+                return {}
+        finally:
+            f.close()
+        if not isinstance(dirs, dict):
+            return {}
+        return dirs
+
+    def _save(self):
+        if self.file_name is None:
+            return
+        try:
+            atomic_write(self.file_name,
+                         pickle.dumps(self._dirs, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            pass
+
+def _sub_author(author_name, path):
+    """
+    Author name for books in a subdirectory
+    """
+    if not author_name or ',' not in author_name:
+        return path
+    return author_name
+
+def fold_text(text):
+    """
+    Lowercase `text` and strip diacritics from it
+
+    :Returns:
+        unicode
+    """
+    if not isinstance(text, unicode):
+        text = unicode(text, 'utf-8', 'replace')
+    text = text.lower()
+    try:
+        text.encode('ascii')
+        return text
+    except UnicodeError:
+        pass
+    return u''.join([c for c in unicodedata.normalize('NFKD', text)
+                     if not unicodedata.combining(c)])
+
+class SearchIndex(object):
+    """
+    Accent- and case-insensitive substring index.
+
+    Texts are folded with `fold_text` and indexed by their trigrams,
+    so that a query only verifies rows that contain all trigrams of
+    its terms.
+    """
+
+    def __init__(self):
+        self._texts = {}
+        self._postings = {}
+
+    def add(self, row_id, text):
+        if row_id in self._texts:
+            self.remove(row_id)
+        text = fold_text(text)
+        self._texts[row_id] = text
+        for gram in self._grams(text):
+            self._postings.setdefault(gram, set()).add(row_id)
+
+    def remove(self, row_id):
+        text = self._texts.pop(row_id, None)
+        if text is None:
+            return
+        for gram in self._grams(text):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(row_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def clear(self):
+        self._texts = {}
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._texts)
+
+    def search(self, terms, candidates=None):
+        """
+        Find rows whose text contains all of the given terms
+
+        If `candidates` is given, only those rows are considered.
+
+        :Returns:
+            set of row ids
+        """
+        terms = [fold_text(t) for t in terms]
+        if candidates is not None:
+            hits = candidates
+        else:
+            hits = None
+            # Longest terms first: they have the smallest postings
+            for term in sorted(terms, key=len, reverse=True):
+                found = self._lookup(term)
+                if hits is None:
+                    hits = found
+                else:
+                    hits &= found
+                if not hits:
+                    return set()
+            if hits is None:
+                return set(self._texts)
+        texts = self._texts
+        return set([row_id for row_id in hits
+                    if row_id in texts
+                    and all(t in texts[row_id] for t in terms)])
+
+    def matches(self, row_id, terms):
+        """
+        Check whether the text of a row contains all of the given terms
+        """
+        text = self._texts.get(row_id)
+        if text is None:
+            return False
+        return all(fold_text(t) in text for t in terms)
+
+    def _lookup(self, term):
+        """
+        Rows that may contain `term`
+        """
+        if len(term) >= 3:
+            grams = [self._postings.get(term[j:j+3], set())
+                     for j in xrange(len(term) - 2)]
+            grams.sort(key=len)
+            found = set(grams[0])
+            for ids in grams[1:]:
+                found &= ids
+                if not found:
+                    break
+            return found
+        else:
+            # Texts are padded, so every short substring starts some trigram
+            found = set()
+            for gram, ids in self._postings.iteritems():
+                if gram.startswith(term):
+                    found |= ids
+            return found
+
+    def _grams(self, text):
+        text = text + u'\0\0'
+        return set([text[j:j+3] for j in xrange(len(text) - 2)])
+
+def _search_text(row):
+    """
+    Text of an EbookList row that the book filter matches against
+    """
+    text = []
+    for x in row[:3]:
+        if not isinstance(x, unicode):
+            x = unicode(x, 'utf-8', 'replace')
+        text.append(x)
+    return u''.join(text)
+
+def _sort_key(row):
+    """
+    Sort key of an EbookList row: (author, title, language, file_name)
+    """
+    key = []
+    for x in row[:4]:
+        if isinstance(x, unicode):
+            x = x.encode('utf-8')
+        key.append(x)
+    return tuple(key)
+
 class EbookList(gtk.ListStore):
     """
     List of ebooks:
 
         [(author, title, language, file_name, visit_timestamp), ...]
+
+    Rows are kept sorted, unless a sort column is set on the store.
+    There is at most one row per file name.
+
+    `search_index` is a SearchIndex over the author, title and language of
+    each row, keyed by file name, and `generation` is incremented whenever
+    rows are added.
     """
 
-    def __init__(self, search_dirs, recent_map=None):
+    # Time slice (in seconds) for adding rows in GUI thread during refresh
+    REFRESH_TIME_SLICE = 0.05
+    REFRESH_BATCH_SIZE = 250
+
+    def __init__(self, search_dirs, recent_map=None, index_file=None):
         gtk.ListStore.__init__(self, str, str, str, str, int)
         self.search_dirs = search_dirs
+        self.index = LibraryIndex(index_file)
         if recent_map:
             self.recent_map = dict(recent_map)
         else:
             self.recent_map = {}
+        self._keys = []
+        self._rows = {}
+        self.search_index = SearchIndex()
+        self.generation = 0
+        self._refresh_id = 0
+        self._refreshing = False
+        self._watcher = None
 
         def to_show(model, it):
             return model.get(it, 4)[0] > 0
@@ -113,89 +658,316 @@ class EbookList(gtk.ListStore):
             recent_map2[file_name] = stamp
 
         # Update model
-        def walk(model, path, iter, user_data):
-            if model.get(iter, 3)[0] == file_name:
-                model.set_value(iter, 4, stamp)
-                return True
-            else:
-                return False
-        self.foreach(walk, None)
+        it = self.get_file_iter(file_name)
+        if it is not None:
+            self.set_value(it, 4, stamp)
+
+    def get_file_iter(self, file_name):
+        """
+        Get iterator pointing to the row of the given file, or None
+        """
+        if isinstance(file_name, unicode):
+            file_name = file_name.encode('utf-8')
+        return self._rows.get(file_name)
 
     def add(self, author=u"", title=u"", language=u"", file_name=""):
         stamp = self.recent_map.get(file_name, -1)
-        return self.append((author, title, language, file_name, stamp))
+        return self._insert_sorted([(author, title, language, file_name,
+                                     stamp)])
 
     def delete_file(self, it):
         entry = self[it]
         fn = entry[3]
         if os.path.isfile(entry[3]):
             os.unlink(entry[3])
+        self._remove_row(it)
+
+    def clear(self):
+        gtk.ListStore.clear(self)
+        self._keys = []
+        self._rows = {}
+        self.search_index.clear()
+        self.generation += 1
+
+    def _insert_sorted(self, rows):
+        """
+        Insert rows at their sorted positions
+
+        :Returns:
+            Iterator pointing to the last inserted row
+        """
+        rows = [(_sort_key(row), row) for row in rows]
+        rows.sort()
+        for key, row in rows:
+            # replace old rows of the same file
+            if key[3] in self._rows:
+                self._remove_row(self._rows[key[3]])
+        it = None
+        for j, (key, row) in enumerate(rows):
+            # rows inserted before this one in this batch sort before it
+            pos = bisect.bisect_right(self._keys, key) + j
+            it = self.insert(pos, row)
+            # ListStore iterators stay valid while the row exists
+            self._rows[key[3]] = it
+            self.search_index.add(key[3], _search_text(row))
+        self._keys.extend([key for key, row in rows])
+        self._keys.sort()
+        self.generation += 1
+        return it
+
+    def _remove_row(self, it):
+        key = _sort_key(self[it])
+        j = bisect.bisect_left(self._keys, key)
+        if j < len(self._keys) and self._keys[j] == key:
+            del self._keys[j]
+        self._rows.pop(key[3], None)
+        self.search_index.remove(key[3])
         self.remove(it)
 
     def refresh(self, callback=None):
+        """
+        Rescan the book directories.
+
+        Books are added to the list in batches while the scan progresses.
+        `callback` is called with True when the scan is complete.
+        """
         self.clear()
+        self._refresh_id += 1
+        self._refreshing = True
+        refresh_id = self._refresh_id
 
-        def walk_tree(files, d, author_name=""):
-            if not os.path.isdir(d):
-                return
+        pending = []
+        finished = [False]
 
-            try:
-                paths = os.listdir(d)
-            except OSError:
-                # permission error, etc.
+        def add_batch():
+            if refresh_id != self._refresh_id:
+                # superseded by a newer refresh
                 return
-            
-            for path in paths:
-                full_path = os.path.join(d, path)
-                if os.path.isdir(full_path):
-                    # recurse into a directory
-                    was_author = (',' in author_name)
-                    if not author_name or not was_author:
-                        walk_tree(files, full_path, path)
-                    else:
-                        walk_tree(files, full_path, author_name)
-                else:
-                    base = get_valid_basename(path)
-                    if base is None:
-                        continue # not a valid file
-                    
-                    # a file or something like that
-                    entry = None
-                    for reg in FILE_RES:
-                        m = reg.match(base)
-                        if m:
-                            g = m.groupdict()
-                            entry = (reformat_auth(g.get('auth', author_name)),
-                                     reformat_title(g.get('titl', base)),
-                                     g.get('lang', ''),
-                                     full_path,
-                                     self.recent_map.get(full_path, -1))
-                            break
-                    if entry is None:
-                        entry = (author_name, base, "", full_path,
-                                 self.recent_map.get(full_path, -1))
-                    files.append(entry)
-
-        def reformat_auth(auth):
-            return auth.replace("; ", "\n")
-
-        def reformat_title(title):
-            return title.replace("; ", "\n")
-
-        def really_add(r):
-            for x in r:
-                self.append(x)
+            start = time.time()
+            while pending and time.time() - start < self.REFRESH_TIME_SLICE:
+                batch = pending[:self.REFRESH_BATCH_SIZE]
+                del pending[:len(batch)]
+                self._insert_sorted([x + (self.recent_map.get(x[3], -1),)
+                                     for x in batch])
+            if pending or not finished[0]:
+                run_later_in_gui_thread(50, add_batch)
+                return
+            self._refreshing = False
             if callback:
                 callback(True)
-        
+
         def do_walk_tree(dirs):
-            files = []
-            for d in dirs:
-                walk_tree(files, d)
-            files.sort()
-            run_in_gui_thread(really_add, files)
+            try:
+                self.index.scan(dirs, callback=pending.extend)
+            finally:
+                finished[0] = True
 
         start_thread(do_walk_tree, self.search_dirs)
+        run_in_gui_thread(add_batch)
+
+    def start_watching(self, poll_interval=60):
+        """
+        Keep the list up to date with changes in the book directories.
+
+        Uses inotify if pyinotify is available, and otherwise checks
+        for changes every `poll_interval` seconds.
+        """
+        if self._watcher is None:
+            self._watcher = LibraryWatcher(self, poll_interval)
+            self._watcher.start()
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _apply_scan(self, files):
+        """
+        Update the list to match a list of books found by a scan
+        """
+        new_keys = set([_sort_key(x) for x in files])
+        old_keys = set(self._keys)
+        self._apply_changes(old_keys - new_keys, new_keys - old_keys)
+
+    def _apply_changes(self, removed, added):
+        """
+        Remove and add the given books
+        """
+        for x in removed:
+            it = self._rows.get(_sort_key(x)[3])
+            if it is not None:
+                self._remove_row(it)
+
+        rows = []
+        for x in added:
+            key = _sort_key(x)
+            rows.append(key + (self.recent_map.get(key[3], -1),))
+        if rows:
+            self._insert_sorted(rows)
+
+def _close_watch_manager(manager):
+    if hasattr(manager, 'close'):
+        manager.close()
+    else:
+        # older pyinotify
+        os.close(manager._fd)
+
+class LibraryWatcher(object):
+    """
+    Watch the book directories of an EbookList for changes.
+
+    With inotify, only the directories in which changes were reported
+    are rescanned through the library index. Otherwise, or if events
+    were lost, the whole library is rescanned; the index then lists
+    only the directories whose modification time changed. The
+    difference is applied to the list.
+    """
+
+    # Delay (in milliseconds) for collecting bursts of inotify events
+    EVENT_DELAY = 1000
+
+    def __init__(self, ebook_list, poll_interval=60):
+        self.ebook_list = ebook_list
+        self.poll_interval = poll_interval
+        self._runner = SingleRunner(max_delay=5*self.EVENT_DELAY)
+        self._notifier = None
+        self._start_id = 0
+        self._active = False
+        self._scanning = False
+        self._changed_dirs = set()
+        self._rescan_all = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._active = True
+        self._start_id += 1
+        if pyinotify is None:
+            self._schedule_poll()
+            return
+
+        # Watches are placed on the whole tree, so do it in background
+        start_id = self._start_id
+        def done(manager):
+            if isinstance(manager, Exception):
+                if self._active and start_id == self._start_id:
+                    print >> sys.stderr, (
+                        "Watching book directories failed (%s); checking "
+                        "for changes every %d s" % (manager,
+                                                    self.poll_interval))
+                    self._schedule_poll()
+            elif not self._active or start_id != self._start_id:
+                _close_watch_manager(manager)
+            else:
+                self._start_notifier(manager)
+
+        run_in_background(self._watch_dirs, callback=done,
+                          priority=PRIORITY_BACKGROUND)
+
+    def stop(self):
+        self._active = False
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    def _watch_dirs(self):
+        """
+        Set up inotify watches on the book directories
+
+        :Returns:
+            pyinotify.WatchManager
+        """
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE
+                | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+                | pyinotify.IN_DELETE_SELF)
+        try:
+            for d in self.ebook_list.search_dirs:
+                if not os.path.isdir(d):
+                    continue
+                wds = manager.add_watch(os.path.abspath(d), mask,
+                                        rec=True, auto_add=True)
+                for path, wd in wds.iteritems():
+                    if wd < 0:
+                        # e.g. out of inotify watches
+                        raise OSError("cannot watch %s" % path)
+        except:
+            _close_watch_manager(manager)
+            raise
+        return manager
+
+    def _start_notifier(self, manager):
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                # called in the notifier thread
+                watcher._add_change(event)
+                run_in_gui_thread(watcher._on_event)
+
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.setDaemon(True)
+        self._notifier.start()
+
+    def _add_change(self, event):
+        self._lock.acquire()
+        try:
+            if event.mask & pyinotify.IN_Q_OVERFLOW or not event.path:
+                self._rescan_all = True
+            else:
+                self._changed_dirs.add(os.path.abspath(event.path))
+        finally:
+            self._lock.release()
+
+    def _on_event(self):
+        self._runner.run_later_in_gui_thread(self.EVENT_DELAY, self._update)
+
+    def _schedule_poll(self):
+        def poll():
+            if self._active:
+                self._rescan_all = True
+                self._update()
+                self._schedule_poll()
+        run_later_in_gui_thread(int(1000*self.poll_interval), poll)
+
+    def _update(self):
+        if not self._active:
+            return
+        if self._scanning or self.ebook_list._refreshing:
+            # try again when the current scan is done
+            self._runner.run_later_in_gui_thread(self.EVENT_DELAY,
+                                                 self._update)
+            return
+
+        self._lock.acquire()
+        try:
+            rescan_all, dirs = self._rescan_all, self._changed_dirs
+            self._rescan_all = False
+            self._changed_dirs = set()
+        finally:
+            self._lock.release()
+        if not rescan_all and not dirs:
+            return
+
+        self._scanning = True
+
+        def done(result):
+            self._scanning = False
+            if not self._active or self.ebook_list._refreshing:
+                return
+            if isinstance(result, Exception):
+                return
+            if rescan_all:
+                self.ebook_list._apply_scan(result)
+            else:
+                self.ebook_list._apply_changes(*result)
+
+        if rescan_all:
+            run_in_background(self.ebook_list.index.scan,
+                              self.ebook_list.search_dirs, callback=done,
+                              priority=PRIORITY_BACKGROUND)
+        else:
+            run_in_background(self.ebook_list.index.rescan, dirs,
+                              callback=done, priority=PRIORITY_BACKGROUND)
 
 
 #------------------------------------------------------------------------------
@@ -209,13 +981,22 @@ class GutenbergSearchList(gtk.ListStore):
     List of search results:
 
         [(author, title, language, category, etext_id, author_other), ...]
+
+    If `prefetch_pages` is nonzero, up to that many result pages
+    following the one shown are fetched in background in advance.
     """
 
-    def __init__(self):
+    def __init__(self, prefetch_pages=0):
         gtk.ListStore.__init__(self, str, str, str, str, int, str)
         self.pages = []
         self.pageno = 0
         self.last_search = None
+        self.prefetch_pages = prefetch_pages
+        self._generation = 0
+        self._task = None
+        self._prefetched = {}
+        self._prefetch_tasks = {}
+        self._prefetch_waiting = {}
 
     def add(self, author=u"", title=u"", language=u"",
             category=u"", etext_id=-1, author_other=u""):
@@ -227,6 +1008,7 @@ class GutenbergSearchList(gtk.ListStore):
         self.pages = []
         self.pageno = 0
         self.last_search = dict(author=author, title=title, subject=subject)
+        self._cancel_prefetch()
 
         def on_finish(r):
             if isinstance(r, Exception):
@@ -237,10 +1019,9 @@ class GutenbergSearchList(gtk.ListStore):
             self._repopulate(r)
             if callback:
                 callback(True)
+            self._prefetch()
 
-        run_in_background(gutenbergweb.search,
-                          author=author, title=title, subject=subject,
-                          pageno=0, callback=on_finish)
+        self._start_search(on_finish, pageno=0, **self.last_search)
 
     def next_page(self, callback=None, pre_callback=None):
         def on_finish(r):
@@ -254,63 +1035,124 @@ class GutenbergSearchList(gtk.ListStore):
             self._repopulate(r)
             if callback:
                 callback(True)
+            self._prefetch()
+
+        pageno = self.pageno + 1
+        if pageno in self._prefetched:
+            generation = self._supersede()
+            result = self._prefetched.pop(pageno)
+            def show_prefetched():
+                if generation == self._generation:
+                    on_finish(result)
+            run_in_gui_thread(show_prefetched)
+        elif pageno in self._prefetch_tasks:
+            # Prefetch of this page is in progress; wait for it
+            self._supersede()
+            self._prefetch_waiting[pageno] = (self._generation, on_finish)
+        else:
+            self._start_search(on_finish, pageno=pageno, **self.last_search)
 
-        run_in_background(gutenbergweb.search, pageno=self.pageno + 1,
-                          callback=on_finish, **self.last_search)
+    def _supersede(self):
+        """
+        Cancel any search in progress
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._generation += 1
+        return self._generation
 
-    def _repopulate(self, result):
-        self.clear()
+    def _start_search(self, on_finish, **kw):
+        """
+        Run a search in background, superseding any earlier one still
+        in progress: its page is not parsed, and its callback not called.
+        """
+        generation = self._supersede()
 
-        if result:
-            if self.pageno >= len(self.pages):
-                self.pages.extend([None] * (self.pageno+1-len(self.pages)))
-            self.pages[self.pageno] = result
+        def is_stale():
+            return generation != self._generation
 
-        for r in self.pages:
-            if not r:
+        self._task = run_in_background(gutenbergweb.search,
+                                       cancelled=is_stale,
+                                       callback=on_finish,
+                                       priority=PRIORITY_INTERACTIVE, **kw)
+
+    def _prefetch(self):
+        """
+        Start fetching the pages following the current one
+        """
+        for pageno in xrange(self.pageno + 1,
+                             self.pageno + 1 + self.prefetch_pages):
+            if pageno in self._prefetched:
+                if not self._prefetched[pageno]:
+                    # end of results
+                    break
                 continue
-            for x in r:
-                author, author_other = self._format_authors(x[1])
-                if x[4].lower().strip() == 'audio book':
-                    # XXX: Don't show audio books since we don't handle them
-                    #      in a reasonable way yet...
-                    continue
-                self.add(author, self._format_title(x[2]), x[3], x[4], x[0],
-                         ellipsize(author_other, max_length=320))
+            elif pageno in self._prefetch_tasks:
+                continue
+
+            def on_prefetch(r, pageno=pageno):
+                del self._prefetch_tasks[pageno]
+                waiting = self._prefetch_waiting.pop(pageno, None)
+                if waiting is not None and waiting[0] == self._generation:
+                    waiting[1](r)
+                elif not isinstance(r, Exception):
+                    self._prefetched[pageno] = r
+                    self._prefetch()
+
+            self._prefetch_tasks[pageno] = run_in_background(
+                gutenbergweb.search, pageno=pageno, callback=on_prefetch,
+                priority=PRIORITY_BACKGROUND, **self.last_search)
+
+    def _cancel_prefetch(self):
+        for task in self._prefetch_tasks.itervalues():
+            task.cancel()
+        self._prefetch_tasks.clear()
+        self._prefetch_waiting.clear()
+        self._prefetched.clear()
+
+    def _repopulate(self, result):
+        """
+        Show the result page `self.pageno`: the first page replaces
+        the list contents, later ones are appended to it.
+        """
+        if self.pageno == 0:
+            self.clear()
+        else:
+            # Drop the "(More...)" entry of the previous page
+            n = len(self)
+            if n > 0 and self[n-1][4] == NEXT_ID:
+                self.remove(self.get_iter((n-1,)))
+
+        if not result:
+            return
+
+        if self.pageno >= len(self.pages):
+            self.pages.extend([None] * (self.pageno+1-len(self.pages)))
+        self.pages[self.pageno] = result
+
+        for x in result:
+            if x[4].lower().strip() == 'audio book':
+                # XXX: Don't show audio books since we don't handle them
+                #      in a reasonable way yet...
+                continue
+            author, author_other = self._format_authors(x[1])
+            self.add(author, self._format_title(x[2]), x[3], x[4], x[0],
+                     author_other)
 
-        if result:
-            self.add(_('(More...)'), '', '', '', NEXT_ID, '')
+        self.add(_('(More...)'), '', '', '', NEXT_ID, '')
 
     def _format_title(self, title):
         """
         Reformat title, by shuffling articles to the end
         """
-        return ellipsize(transpose_articles(title), max_length=80)
+        return format_title(title)
 
     def _format_authors(self, author_list):
         """
         Reformat author list, by keeping 'main' authors only
         """
-        authors = []
-        author_other = []
-        for name, real_name, date, role in author_list:
-            if role == 'author':
-                authors.append(name)
-                s = u""
-            elif role == 'translator' and len(author_list) == 2:
-                authors.append(u"tr. " + name)
-                s = u""
-            else:
-                s = name
-            if real_name:
-                s += " (%s)" % real_name
-            if date:
-                s += " " + date
-            if role and s:
-                s += " [%s]" % role
-            author_other.append(s.lstrip())
-        return u"\n".join(authors), ellipsize(u"; ".join(author_other),
-                                              max_length=160)
+        return format_authors(tuple(author_list))
 
     def get_downloads(self, it, callback=None):
         author, title, language, category, etext_id, author_other = self[it]
@@ -330,10 +1172,49 @@ class GutenbergSearchList(gtk.ListStore):
                 callback(info)
 
         run_in_background(gutenbergweb.etext_info, etext_id,
-                          callback=on_finish)
+                          callback=on_finish, priority=PRIORITY_INTERACTIVE)
         
         return info
 
+@memoize(4096)
+def format_title(title):
+    """
+    Reformat title, by shuffling articles to the end
+    """
+    return ellipsize(transpose_articles(title), max_length=80)
+
+@memoize(4096)
+def format_authors(author_list):
+    """
+    Reformat author list, by keeping 'main' authors only
+
+    :Returns:
+        (authors, author_other)
+    """
+    authors = []
+    author_other = []
+    for name, real_name, date, role in author_list:
+        if role == 'author':
+            authors.append(name)
+            s = u""
+        elif role == 'translator' and len(author_list) == 2:
+            authors.append(u"tr. " + name)
+            s = u""
+        else:
+            s = name
+        if real_name:
+            s += " (%s)" % real_name
+        if date:
+            s += " " + date
+        if role and s:
+            s += " [%s]" % role
+        author_other.append(s.lstrip())
+    return u"\n".join(authors), ellipsize(u"; ".join(author_other),
+                                          max_length=160)
+
+_ARTICLE_TAIL_RE = re.compile(u"^([^,\u2012-\u2015-]+)(.*?)$")
+_TRAILING_SPACE_RE = re.compile(ur"^(.*?)(\s*)$")
+
 def transpose_articles(text):
     """
     Move articles 'The', 'A', and 'An' to the end.
@@ -342,9 +1223,9 @@ def transpose_articles(text):
     for article in (u"The", u"A", u"An"):
         pre = article + u" "
         if parts[0].startswith(pre):
-            m = re.match(u"^([^,\u2012-\u2015-]+)(.*?)$", parts[0][len(pre):])
+            m = _ARTICLE_TAIL_RE.match(parts[0][len(pre):])
             if m:
-                m2 = re.match(ur"^(.*?)(\s*)$", m.group(1))
+                m2 = _TRAILING_SPACE_RE.match(m.group(1))
                 if m2:
                     p = m2.group(1) + u", " + article + m2.group(2) + m.group(2)
                 else:
@@ -486,7 +1367,8 @@ class DownloadInfo(gtk.ListStore):
             if callback:
                 callback(path)
         
-        run_in_background(do_download, url, callback=on_finish)
+        run_in_background(do_download, url, callback=on_finish,
+                          priority=PRIORITY_BACKGROUND)
 
 def trim_filename(fn, max_length=255):
     if len(fn) <= max_length:
@@ -521,14 +1403,93 @@ def clean_filename(s):
 # Configuration backend
 #------------------------------------------------------------------------------
 
+def _journal_record(obj):
+    """
+    Serialize a journal record: length, CRC-32 and marshalled data
+    """
+    data = marshal.dumps(obj)
+    return struct.pack('<II', len(data), zlib.crc32(data) & 0xffffffff) + data
+
+def _read_journal_records(f):
+    """
+    Iterate over the records in a journal, up to the first incomplete
+    or damaged one
+    """
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, crc = struct.unpack('<II', header)
+        data = f.read(size)
+        if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+            return
+        try:
+            yield marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            return
+
 class Config(dict):
     """
-    Very simple configuration file with basic-type XML object serialization
+    Very simple configuration file with basic-type object serialization
+
+    The configuration is stored with marshal, and written atomically.
+    Configuration in the former XML format is migrated on first load.
+
+    Changes made with `__setitem__`, `set_entry` or marked with `mark_dirty`
+    can be appended to a journal with `save_changes`, which is cheap and
+    safe to call from a background thread. `save` writes the whole
+    configuration and starts a new journal.
     """
-    def __init__(self, schema):
-        home = os.path.expanduser("~")
-        self.file_name = os.path.join(home, '.mgutenbergrc')
+    FORMAT = 'mgutenberg-config'
+    VERSION = 2
+
+    SAVE_DELAY = 5000
+    SAVE_MAX_DELAY = 30000
+
+    def __init__(self, schema, file_name=None, xml_file_name=None):
+        if file_name is None:
+            file_name = cache_file_name('config')
+        if xml_file_name is None:
+            xml_file_name = os.path.join(os.path.expanduser("~"),
+                                         '.mgutenbergrc')
+        self.file_name = file_name
+        self.journal_file_name = file_name + '.journal'
+        self.xml_file_name = xml_file_name
         self.schema = schema
+        self._journal_id = None
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._save_runner = SingleRunner(max_delay=self.SAVE_MAX_DELAY)
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            dict.__setitem__(self, key, value)
+            self._dirty.add((key, None))
+        finally:
+            self._lock.release()
+
+    def set_entry(self, key, subkey, value):
+        """
+        Set config[key][subkey] = value, and mark it changed
+        """
+        self._lock.acquire()
+        try:
+            self.setdefault(key, {})[subkey] = value
+            self._dirty.add((key, subkey))
+        finally:
+            self._lock.release()
+
+    def mark_dirty(self, key, subkey=None):
+        """
+        Mark config[key], or config[key][subkey], as changed
+        """
+        self._lock.acquire()
+        try:
+            self._dirty.add((key, subkey))
+        finally:
+            self._lock.release()
 
     def _toxml(self, o):
         if isinstance(o, list):
@@ -582,7 +1543,93 @@ class Config(dict):
             return None
 
     def load(self):
-        f = open(self.file_name, 'rb')
+        """
+        Load the configuration
+
+        A configuration file that cannot be read is moved aside, and
+        the configuration is migrated from the XML file instead.
+
+        Raises IOError if no configuration file exists.
+        """
+        try:
+            f = open(self.file_name, 'rb')
+        except IOError:
+            self._migrate_xml()
+            return
+
+        try:
+            try:
+                data = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                data = None
+        finally:
+            f.close()
+
+        if (not isinstance(data, tuple) or len(data) != 4
+                or data[0] != self.FORMAT or data[1] != self.VERSION
+                or not isinstance(data[3], dict)):
+            if isinstance(data, tuple) and len(data) >= 2:
+                what = "format %r, version %r" % data[:2]
+            else:
+                what = "unknown format"
+            print >> sys.stderr, (
+                "Configuration file %s not recognized (%s), moving it to "
+                "%s.old" % (self.file_name, what, self.file_name))
+            for fn in (self.file_name, self.journal_file_name):
+                if os.path.exists(fn):
+                    os.rename(fn, fn + '.old')
+            self._migrate_xml()
+            return
+        journal_id, d = data[2:]
+        self._replay_journal(d, journal_id)
+        self._coerce_schema(d)
+        self._lock.acquire()
+        try:
+            self.clear()
+            self.update(d)
+            self._journal_id = journal_id
+            self._dirty.clear()
+        finally:
+            self._lock.release()
+
+    def _replay_journal(self, d, journal_id):
+        """
+        Apply the changes in the journal belonging to the loaded file
+        """
+        try:
+            f = open(self.journal_file_name, 'rb')
+        except IOError:
+            return
+        try:
+            records = _read_journal_records(f)
+            try:
+                if records.next() != (self.FORMAT, journal_id):
+                    return
+                for key, subkey, present, value in records:
+                    if subkey is None:
+                        target, name = d, key
+                    else:
+                        target, name = d.get(key), subkey
+                        if not isinstance(target, dict):
+                            target = d[key] = {}
+                    if present:
+                        target[name] = value
+                    else:
+                        target.pop(name, None)
+            except (StopIteration, ValueError, TypeError):
+                pass
+        finally:
+            f.close()
+
+    def _migrate_xml(self):
+        self._load_xml()
+        try:
+            self.save()
+        except (IOError, OSError):
+            pass
+
+    def _load_xml(self):
+        f = open(self.xml_file_name, 'rb')
         try:
             tree = ET.parse(f)
             d = self._fromxml(tree.getroot())
@@ -595,7 +1642,92 @@ class Config(dict):
             f.close()
 
     def save(self):
-        f = open(self.file_name, 'w')
+        """
+        Write the whole configuration, and start a new journal
+        """
+        self._file_lock.acquire()
+        try:
+            journal_id = random.randint(1, 2**30)
+            self._lock.acquire()
+            try:
+                data = marshal.dumps((self.FORMAT, self.VERSION, journal_id,
+                                      dict(self)))
+                self._dirty.clear()
+            finally:
+                self._lock.release()
+            atomic_write(self.file_name, data)
+            self._journal_id = journal_id
+            if os.path.exists(self.journal_file_name):
+                os.unlink(self.journal_file_name)
+        finally:
+            self._file_lock.release()
+
+    def save_changes(self):
+        """
+        Append changed entries to the journal
+        """
+        if self._journal_id is None:
+            # Nothing saved yet to which a journal could belong
+            self.save()
+            return
+
+        self._file_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                records = []
+                for key, subkey in self._dirty:
+                    if subkey is None:
+                        present = key in self
+                        value = self.get(key)
+                    else:
+                        target = self.get(key)
+                        present = isinstance(target, dict) and subkey in target
+                        value = None
+                        if present:
+                            value = target[subkey]
+                    records.append(_journal_record((key, subkey, present,
+                                                    value)))
+                self._dirty.clear()
+            finally:
+                self._lock.release()
+            if not records:
+                return
+
+            if not os.path.exists(self.journal_file_name):
+                records.insert(0, _journal_record((self.FORMAT,
+                                                   self._journal_id)))
+            f = open(self.journal_file_name, 'ab')
+            try:
+                f.write(''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        finally:
+            self._file_lock.release()
+
+    def save_later(self):
+        """
+        Append changes to the journal in a background thread, once changes
+        have stopped for a while
+        """
+        def done(result):
+            if isinstance(result, Exception):
+                print >> sys.stderr, "Saving configuration failed: %s" % (
+                    result,)
+
+        def run():
+            run_in_background(self.save_changes, callback=done,
+                              priority=PRIORITY_BACKGROUND)
+
+        self._save_runner.run_later_in_gui_thread(self.SAVE_DELAY, run)
+
+    def save_xml(self):
+        """
+        Save the configuration in the former XML format
+        """
+        f = open(self.xml_file_name, 'w')
         try:
             root = self._toxml(self)
             tree = ET.ElementTree(root)
@@ -638,7 +1770,7 @@ class Config(dict):
             else:
                 pass # OK
 
-        for k, v in self.iteritems():
+        for k, v in d.items():
             try:
                 if k not in self.schema:
                     raise WalkError()
@@ -10,8 +10,16 @@ import os
 import gzip
 import bz2
 import zipfile
-import textwrap
+import codecs
 import re
+import time
+import itertools
+import bisect
+import struct
+import marshal
+import tempfile
+import hashlib
+import threading
 from StringIO import StringIO
 
 from HTMLParser import HTMLParser
@@ -19,29 +27,371 @@ import htmlentitydefs
 
 import xml.etree.ElementTree as etree
 import plucker
+from guithread import run_later_in_gui_thread
 
 class UnsupportedFormat(IOError):
     pass
 
+SECTION_SIZE = 20000
+
+class _Sections(object):
+    """
+    Division of a book into sections of about SECTION_SIZE characters.
+
+    `boundaries` is the sorted list of section start offsets, followed by
+    the length of the book.
+    """
+
+    @property
+    def length(self):
+        return self.boundaries[-1]
+
+    @property
+    def section_count(self):
+        return len(self.boundaries) - 1
+
+    def section_at(self, offset):
+        """
+        Index of the section containing the book offset `offset`
+        """
+        k = bisect.bisect_right(self.boundaries, offset) - 1
+        return max(0, min(k, self.section_count - 1))
+
+class ParsedBook(_Sections):
+    """
+    Text of a book, with its formatting.
+
+    `runs` is a sorted list of non-overlapping ``(start, end, tag_names)``
+    character ranges of `text`.
+    """
+
+    def __init__(self, text, runs):
+        self.text = text
+        self.runs = runs
+        self._run_starts = [r[0] for r in runs]
+        self._boundaries = None
+
+    @property
+    def boundaries(self):
+        if self._boundaries is None:
+            self._boundaries = _split_sections(self.text, self.runs)
+        return self._boundaries
+
+    def runs_between(self, start, end):
+        """
+        Formatting runs, clipped to the range [start, end)
+        """
+        k = max(0, bisect.bisect_right(self._run_starts, start) - 1)
+        runs = []
+        for s, e, tags in self.runs[k:]:
+            if s >= end:
+                break
+            if e > start:
+                runs.append((max(s, start), min(e, end), tags))
+        return runs
+
+    def read_section(self, k):
+        """
+        :Returns:
+            text, runs of the section `k`
+        """
+        start, end = self.boundaries[k:k+2]
+        return self.text[start:end], self.runs_between(start, end)
+
+class PagedBook(_Sections):
+    """
+    Book stored in a file, of which only the requested sections are read
+    into memory.
+
+    The file contains the sections, each a marshalled ``(utf-8 text,
+    runs)`` pair, followed by the marshalled index and its position.
+    """
+
+    MAGIC = 'MGBOOK1\n'
+    CACHED_SECTIONS = 3
+
+    def __init__(self, f):
+        self._file = f
+        self._cache = []
+
+        f.seek(-8, 2)
+        index_pos, = struct.unpack('<Q', f.read(8))
+        f.seek(0)
+        if f.read(len(self.MAGIC)) != self.MAGIC:
+            raise IOError("Not a paged book file")
+        f.seek(index_pos)
+        self.boundaries, self._positions = marshal.load(f)
+
+    @classmethod
+    def create(cls, book, f=None):
+        """
+        Write a ParsedBook to a file, by default a temporary one
+
+        :Returns:
+            PagedBook
+        """
+        if f is None:
+            f = tempfile.TemporaryFile()
+        f.write(cls.MAGIC)
+        positions = []
+        for k in xrange(book.section_count):
+            positions.append(f.tell())
+            text, runs = book.read_section(k)
+            start = book.boundaries[k]
+            runs = [(s - start, e - start, tags) for s, e, tags in runs]
+            marshal.dump((text.encode('utf-8'), runs), f)
+        positions.append(f.tell())
+        marshal.dump((book.boundaries, positions), f)
+        f.write(struct.pack('<Q', positions[-1]))
+        f.flush()
+        return cls(f)
+
+    def read_section(self, k):
+        """
+        :Returns:
+            text, runs of the section `k`
+        """
+        for item in self._cache:
+            if item[0] == k:
+                return item[1:]
+
+        self._file.seek(self._positions[k])
+        data = self._file.read(self._positions[k+1] - self._positions[k])
+        text, runs = marshal.loads(data)
+        start = self.boundaries[k]
+        item = (k, unicode(text, 'utf-8'),
+                [(s + start, e + start, tags) for s, e, tags in runs])
+
+        self._cache.insert(0, item)
+        del self._cache[self.CACHED_SECTIONS:]
+        return item[1:]
+
+    def close(self):
+        self._file.close()
+
+def _split_sections(text, runs, size=SECTION_SIZE):
+    """
+    Section boundaries for a text: at headings (runs of the 'big' tag),
+    or else at line starts
+    """
+    headings = [s for s, e, tags in runs if 'big' in tags]
+    boundaries = [0]
+    pos = 0
+    while len(text) - pos > size:
+        # a heading in the second half of the section starts a new one
+        k = bisect.bisect_right(headings, pos + size) - 1
+        if k >= 0 and headings[k] > pos + size // 2:
+            pos = text.rfind(u'\n', pos, headings[k]) + 1 or headings[k]
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+                continue
+
+        pos += size
+        j = text.find(u'\n', pos, pos + 1000)
+        if j >= 0:
+            pos = j + 1
+        elif u'\udc00' <= text[pos] <= u'\udfff':
+            # do not split surrogate pairs
+            pos += 1
+        boundaries.append(pos)
+    if len(text) > 0 or len(boundaries) == 1:
+        boundaries.append(len(text))
+    return boundaries
+
+LARGE_BOOK_SIZE = 1000000
+
+class BookCache(object):
+    """
+    Cache of parsed books, as PagedBook files in a directory.
+
+    Entries are keyed by the path, modification time and size of the
+    book file. The least recently used entries are removed when the
+    total size exceeds `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size=32*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        :Returns:
+            PagedBook, or None if the book is not in the cache
+        """
+        path = self._entry_name(filename)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            book = PagedBook(f)
+        except (IOError, EOFError, ValueError, TypeError, struct.error):
+            f.close()
+            self._remove(path)
+            return None
+        try:
+            # modification time is the time of last use
+            os.utime(path, None)
+        except OSError:
+            pass
+        return book
+
+    def put(self, filename, book):
+        """
+        Store a ParsedBook in the cache
+
+        :Returns:
+            The cached book, as a PagedBook
+        """
+        path = self._entry_name(filename)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            f = os.fdopen(fd, 'w+b')
+            paged = PagedBook.create(book, f)
+            os.rename(tmp_name, path)
+        except:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        self._evict(keep=path)
+        return paged
+
+    def _entry_name(self, filename):
+        st = os.stat(filename)
+        key = repr((os.path.abspath(filename), st.st_mtime, st.st_size,
+                    PagedBook.MAGIC))
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def _evict(self, keep=None):
+        self._lock.acquire()
+        try:
+            entries = []
+            total = 0
+            if keep is not None:
+                total = os.path.getsize(keep)
+            for name in os.listdir(self.directory):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(self.directory, name)
+                if path == keep:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_size:
+                    break
+                self._remove(path)
+                total -= size
+        finally:
+            self._lock.release()
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+_book_cache = None
+
+def set_book_cache(cache):
+    """
+    Use the given BookCache in `open_book` (None disables caching)
+    """
+    global _book_cache
+    _book_cache = cache
+
+def parse_book(filename):
+    """
+    Parse a book file
+
+    :Returns:
+        ParsedBook
+
+    Raises IOError if the file cannot be read, and UnsupportedFormat if
+    its format is not known.
+    """
+    return _BookParser().parse(filename)
+
+def open_book(filename):
+    """
+    Get a parsed book file, from the book cache if possible.
+
+    Parsed books are stored in the cache if one is set. Otherwise, books
+    longer than LARGE_BOOK_SIZE characters are moved out of memory into
+    a temporary file.
+
+    :Returns:
+        ParsedBook or PagedBook
+    """
+    cache = _book_cache
+    if cache is not None:
+        book = cache.get(filename)
+        if book is not None:
+            return book
+
+    book = parse_book(filename)
+    if cache is not None:
+        try:
+            return cache.put(filename, book)
+        except (IOError, OSError):
+            pass
+    if book.length > LARGE_BOOK_SIZE:
+        book = PagedBook.create(book)
+    return book
+
 class EbookText(gtk.TextBuffer):
-    def __init__(self, filename):
+    """
+    Text buffer containing a book.
+
+    The buffer holds a range of sections of the book: `start` is the
+    offset in the book of the beginning of the buffer. With
+    `window_sections` set, at most that many sections around the reading
+    position are kept in the buffer.
+    """
+
+    FILL_TIME_SLICE = 0.05
+    WINDOW_SECTIONS = 5
+
+    def __init__(self, filename, book=None, lazy=False, window_sections=None):
         gtk.TextBuffer.__init__(self)
 
-        self._text = None
+        self.book = book
+        self.window_sections = window_sections
+        self.start = 0
         self._error = None
+        self._fill_id = 0
+        self._filling = False
+        self._sections = (0, 0)
+        self._target = (0, 0)
+        self._prepend_wrapper = None
+        self._callback = None
 
         self.tag_bold = self.create_tag("bold", weight=pango.WEIGHT_BOLD)
         self.tag_emph = self.create_tag("emph", style=pango.STYLE_ITALIC)
         self.tag_big = self.create_tag("big", scale=1.5)
 
-        self._load(filename)
+        if self.book is None:
+            try:
+                self.book = parse_book(filename)
+            except IOError, e:
+                self._error = e
 
-        if self._text:
-            self.set_text(self._text)
+        if self.book is not None and not lazy:
+            self._target = self._get_target(0)
+            while self._fill_step():
+                pass
 
     @property
     def loaded(self):
-        return self._text is not None
+        return self.book is not None
 
     @property
     def error(self):
@@ -49,30 +399,249 @@ class EbookText(gtk.TextBuffer):
             return None
         return str(self._error)
 
+    def fill(self, position=0, prepend_wrapper=None, callback=None):
+        """
+        Load the book into the buffer progressively.
+
+        The section containing the book offset `position` is inserted
+        right away. The rest -- the whole book, or the window around
+        `position` -- follows in time-sliced batches in the GUI thread:
+        first the text after it, then the text before it.
+
+        Text is inserted at, or removed from, the beginning of the buffer
+        by calling ``prepend_wrapper(change)``, which can keep the view in
+        place around the call to ``change()``. `callback` is called when
+        the buffer is complete.
+        """
+        self.stop_fill()
+        self._prepend_wrapper = prepend_wrapper
+        self._callback = callback
+
+        k = self.book.section_at(position)
+        self.delete(self.get_start_iter(), self.get_end_iter())
+        self.start = self.book.boundaries[k]
+        self._insert_section(k, self.get_end_iter())
+        self._sections = (k, k + 1)
+
+        self._target = self._get_target(position)
+        self._schedule_fill()
+
+    def move_window(self, position):
+        """
+        Keep the window of sections around the book offset `position`
+        """
+        if self.window_sections is None or self.book is None:
+            return
+        target = self._get_target(position)
+        if target != self._target:
+            self._target = target
+            self._schedule_fill()
+
+    def stop_fill(self):
+        """
+        Stop loading the rest of the book into the buffer
+        """
+        self._fill_id += 1
+        self._filling = False
+
+    def get_iter_at_book_offset(self, offset):
+        return self.get_iter_at_offset(max(0, offset - self.start))
+
+    def get_book_offset(self, it):
+        return self.start + it.get_offset()
+
+    def _get_target(self, position):
+        """
+        Range of sections to have in the buffer
+        """
+        n = self.book.section_count
+        if self.window_sections is None:
+            return (0, n)
+        k = self.book.section_at(position)
+        first = max(0, min(k - self.window_sections // 2,
+                           n - self.window_sections))
+        return (first, min(n, first + self.window_sections))
+
+    def _schedule_fill(self):
+        if self._filling:
+            return
+        if self._sections == self._target:
+            if self._callback:
+                self._callback()
+            return
+
+        self._filling = True
+        fill_id = self._fill_id
+
+        def fill_batch():
+            if fill_id != self._fill_id:
+                # superseded, or stopped
+                return
+            batch_start = time.time()
+            while time.time() - batch_start < self.FILL_TIME_SLICE:
+                if not self._fill_step():
+                    break
+            if self._sections != self._target:
+                run_later_in_gui_thread(50, fill_batch)
+                return
+            self._filling = False
+            if self._callback:
+                self._callback()
+
+        run_later_in_gui_thread(50, fill_batch)
+
+    def _fill_step(self):
+        """
+        Insert or remove one section to approach the target range
+
+        :Returns:
+            False if the buffer already holds the target range
+        """
+        first, last = self._sections
+        target_first, target_last = self._target
+        boundaries = self.book.boundaries
+
+        if last < target_last and last >= target_first:
+            self._insert_section(last, self.get_end_iter())
+            self._sections = (first, last + 1)
+        elif first > target_first and first <= target_last:
+            def change():
+                self._insert_section(first - 1, self.get_start_iter())
+                self.start = boundaries[first - 1]
+                self._sections = (first - 1, last)
+            self._change_before_view(change)
+        elif last > target_last or last < target_first:
+            # trim the end; if the target lies wholly before the buffer,
+            # this eventually empties it
+            it = self.get_iter_at_book_offset(boundaries[last - 1])
+            self.delete(it, self.get_end_iter())
+            self._sections = (first, last - 1)
+            if first == last - 1:
+                self._restart_at(target_first)
+        elif first < target_first:
+            def change():
+                it = self.get_iter_at_book_offset(boundaries[first + 1])
+                self.delete(self.get_start_iter(), it)
+                self.start = boundaries[first + 1]
+                self._sections = (first + 1, last)
+                if first + 1 == last:
+                    self._restart_at(target_first)
+            self._change_before_view(change)
+        else:
+            return False
+        return True
+
+    def _restart_at(self, k):
+        """
+        Continue from section `k` after the buffer became empty
+        """
+        self.start = self.book.boundaries[k]
+        self._sections = (k, k)
+
+    def _change_before_view(self, change):
+        if self._prepend_wrapper:
+            self._prepend_wrapper(change)
+        else:
+            change()
+
+    def _insert_section(self, k, it):
+        """
+        Insert section `k` of the book, with its formatting, at the
+        iterator `it`
+        """
+        text, runs = self.book.read_section(k)
+        base = it.get_offset() - self.book.boundaries[k]
+        self.insert(it, text.encode('utf-8'))
+        for s, e, tags in runs:
+            s_it = self.get_iter_at_offset(base + s)
+            e_it = self.get_iter_at_offset(base + e)
+            for tag in tags:
+                self.apply_tag_by_name(tag, s_it, e_it)
+
+class _BookParser(object):
+    """
+    Parser of the supported book formats into ParsedBook
+    """
+
+    tag_bold = 'bold'
+    tag_emph = 'emph'
+    tag_big = 'big'
+
+    def __init__(self):
+        self._pieces = []
+        self._piece_tags = []
+        self._length = 0
+
+    def parse(self, filename):
+        self._load(filename)
+
+        text = u"".join(self._pieces)
+        runs = []
+        pos = 0
+        for piece, tags in zip(self._pieces, self._piece_tags):
+            end = pos + len(piece)
+            if tags:
+                if runs and runs[-1][1] == pos and runs[-1][2] == tags:
+                    runs[-1] = (runs[-1][0], end, tags)
+                else:
+                    runs.append((pos, end, tags))
+            pos = end
+        return ParsedBook(text, runs)
+
+    def _append(self, text, tags=()):
+        if not text:
+            return
+        self._pieces.append(text)
+        self._piece_tags.append(tuple(tags))
+        self._length += len(text)
+
+    def _insert(self, offset, text, tags=()):
+        """
+        Insert text at an earlier offset
+        """
+        if not text:
+            return
+        if offset >= self._length:
+            self._append(text, tags)
+            return
+
+        # Insertions are close to the end, so search backwards
+        k = len(self._pieces)
+        pos = self._length
+        while pos > offset:
+            k -= 1
+            pos -= len(self._pieces[k])
+        if pos < offset:
+            piece = self._pieces[k]
+            self._pieces[k:k+1] = [piece[:offset-pos], piece[offset-pos:]]
+            self._piece_tags.insert(k, self._piece_tags[k])
+            k += 1
+        self._pieces.insert(k, text)
+        self._piece_tags.insert(k, tuple(tags))
+        self._length += len(text)
+
     def _load(self, filename):
-        try:
-            basefn, ext = os.path.splitext(filename)
-            if ext == '.gz':
-                f = gzip.open(filename, 'rb')
-                filename = basefn
-            elif ext == '.bz2':
-                f = bz2.BZ2File(filename, 'rb')
-                filename = basefn
-            elif ext == '.zip':
-                zf = zipfile.ZipFile(filename, 'r')
-                filename = self._pick_zip_name(zf.namelist())
-                f = StringIO(zf.read(filename))
-                zf.close()
-            elif ext == '.pdb':
-                f = plucker.PluckerFile(filename)
-            else:
-                f = open(filename, 'rb')
+        basefn, ext = os.path.splitext(filename)
+        if ext == '.gz':
+            f = gzip.open(filename, 'rb')
+            filename = basefn
+        elif ext == '.bz2':
+            f = bz2.BZ2File(filename, 'rb')
+            filename = basefn
+        elif ext == '.zip':
+            zf = zipfile.ZipFile(filename, 'r')
+            filename = self._pick_zip_name(zf.namelist())
+            f = StringIO(zf.read(filename))
+            zf.close()
+        elif ext == '.pdb':
+            f = plucker.PluckerFile(filename)
+        else:
+            f = open(filename, 'rb')
 
+        try:
             self._load_stream(filename, f)
+        finally:
             f.close()
-        except IOError, e:
-            self._text = None
-            self._error = e
 
     def _pick_zip_name(self, names):
         for name in names:
@@ -208,8 +777,7 @@ class EbookText(gtk.TextBuffer):
                 self.para += u'%c' % htmlentitydefs.name2codepoint.get(name, 63)
 
             def _append(self, text):
-                parent.insert_with_tags(parent.get_end_iter(),
-                                        text.encode('utf-8'), *self.tags)
+                parent._append(text, self.tags)
 
             def flush(self):
                 if self.para:
@@ -232,9 +800,7 @@ class EbookText(gtk.TextBuffer):
         def flush_text():
             if not text:
                 return
-            self.insert_with_tags(self.get_end_iter(),
-                                  u"".join(text).encode('utf-8'),
-                                  *tags)
+            self._append(u"".join(text), tags)
             del text[:]
 
         tags = []
@@ -280,16 +846,13 @@ class EbookText(gtk.TextBuffer):
         def flush_text():
             if not text:
                 return
-            self.insert_with_tags(self.get_end_iter(),
-                                  u"".join(text).encode('utf-8'),
-                                  *tags)
+            self._append(u"".join(text), tags)
             del text[:]
 
         NS = "{http://www.gribuser.ru/xml/fictionbook/2.0}"
 
         par_had_text = True
-        par_mark = self.create_mark('par', self.get_end_iter(),
-                                    left_gravity=True)
+        par_mark = self._length
 
         tags = []
         text = []
@@ -306,14 +869,10 @@ class EbookText(gtk.TextBuffer):
                     par_had_text = True
                 else:
                     par_had_text = False
-                    self.move_mark(par_mark, self.get_end_iter())
+                    par_mark = self._length
             elif el_tag == 'p' and event == 'end':
                 if elem.text and not par_had_text:
-                    pos = self.get_iter_at_mark(par_mark)
-                    pos.forward_char()
-                    self.insert_with_tags(pos,
-                                          elem.text.encode('utf-8'),
-                                          *tags)
+                    self._insert(par_mark + 1, elem.text, tags)
                 par_had_text = True
             elif el_tag == 'stanza':
                 text.append(u"\n")
@@ -347,18 +906,9 @@ class EbookText(gtk.TextBuffer):
 
     def _load_plain_text(self, f):
         if isinstance(f, str):
-            raw_text = str
-        else:
-            raw_text = f.read()
-
-        for encoding in detect_encoding(raw_text):
-            try:
-                self._text = unicode(raw_text, encoding)
-                break
-            except UnicodeError:
-                pass
-
-        self._text = rewrap(self._text)
+            f = StringIO(f)
+        for piece in rewrap_blocks(decode_blocks(_read_blocks(f))):
+            self._append(piece)
 
 def detect_encoding(text):
     encodings = ['utf-8']
@@ -368,31 +918,200 @@ def detect_encoding(text):
         encodings.append('latin1')
     return encodings
 
+PLAIN_TEXT_BLOCK_SIZE = 64*1024
+
+def _read_blocks(f, size=PLAIN_TEXT_BLOCK_SIZE):
+    while True:
+        block = f.read(size)
+        if not block:
+            break
+        yield block
+
+def decode_blocks(blocks):
+    """
+    Decode blocks of bytes incrementally, guessing the encoding
+
+    The candidate encodings are probed on the first block. If a later
+    block fails to decode, the remaining candidates are used from that
+    block on, so that the text decoded so far is not decoded again.
+    The last candidate does not fail, but replaces invalid characters.
+
+    :Returns:
+        iterator over pieces of the decoded text
+    """
+    blocks = iter(blocks)
+    ahead = []
+    seen_x92 = False
+    encodings = None
+    rest = ''
+    final = False
+    while not final:
+        if ahead:
+            block = ahead.pop(0)
+        else:
+            try:
+                block = blocks.next()
+                seen_x92 = seen_x92 or '\x92' in block
+            except StopIteration:
+                block = ''
+                final = True
+        data = rest + block
+        if encodings is None:
+            encodings = detect_encoding(data)
+        while True:
+            try:
+                text, consumed = _decode(data, encodings[0], final,
+                                         len(encodings) == 1)
+                break
+            except UnicodeDecodeError:
+                # The fallback depends on whether there is a '\x92'
+                # anywhere in the file, so look for one further on,
+                # keeping the blocks read ahead undecoded
+                if not seen_x92:
+                    for block in blocks:
+                        ahead.append(block)
+                        if '\x92' in block:
+                            seen_x92 = True
+                            break
+                if seen_x92:
+                    sample = '\x92'
+                else:
+                    sample = ''
+                encodings = detect_encoding(sample)[1-len(encodings):]
+        rest = data[consumed:]
+        yield text
+
+def _decode(data, encoding, final, last):
+    """
+    Decode as much of `data` as possible
+
+    :Returns:
+        text, number of bytes consumed
+    """
+    if last:
+        errors = 'replace'
+    else:
+        errors = 'strict'
+    if encoding == 'utf-8':
+        return codecs.utf_8_decode(data, errors, final)
+    return unicode(data, encoding, errors), len(data)
+
+REWRAP_SAMPLE_SIZE = 80*1000
+REWRAP_BLOCK_SIZE = 64*1024
+
+_WHITESPACE = u' \t\n\r\f\v'
+_DASH_LINE_RE = re.compile(r'-{10,}')
+_EQUALS_LINE_RE = re.compile(r'={10,}')
+_WHITESPACE_LINE_RE = re.compile(u'^[ \t]+$', re.M)
+_LEADING_WHITESPACE_RE = re.compile(u'(^[ \t]*)(?:[^ \t\n])', re.M)
+_INDENT_JOIN_RE = re.compile(u'\n(?!\\s)')
+_EMPTY_JOIN_RE = re.compile(u'\n(?!\n)')
+_LONG_WHITESPACE_RE = re.compile(u'\\s{10,}')
+_NEWLINE_INDENT_RE = re.compile(u'\n[ \t]+')
+
 def rewrap(text):
+    """
+    Join the lines of paragraphs in a plain text book, and clean it up
+    """
     if not text:
         return
+    blocks = (text[j:j+REWRAP_BLOCK_SIZE]
+              for j in xrange(0, len(text), REWRAP_BLOCK_SIZE))
+    return u''.join(rewrap_blocks(blocks))
+
+def rewrap_blocks(blocks):
+    """
+    Rewrap text given as an iterable of consecutive pieces, in one pass
+
+    The paragraph style is detected from the first REWRAP_SAMPLE_SIZE
+    characters, so only those are held back -- and everything until a
+    line without leading whitespace is seen, as the common indentation
+    must be known first.
 
-    # remove lines
-    text = re.sub(r'-{10,}', '', text)
-    text = re.sub(r'={10,}', '', text)
+    :Returns:
+        iterator over pieces of the rewrapped text
+    """
+    # Collect the sample, and the common indentation
+    head = []
+    head_size = 0
+    margin = None
+    pieces = _line_pieces(blocks)
+    for piece in pieces:
+        piece = _clean_piece(piece)
+        head.append(piece)
+        head_size += len(piece)
+        if margin != u'':
+            for indent in set(_LEADING_WHITESPACE_RE.findall(piece)):
+                margin = _common_prefix(margin, indent)
+        if margin == u'' and head_size >= REWRAP_SAMPLE_SIZE:
+            break
 
-    text = text.replace(u'\r', u'')
-    text = textwrap.dedent(text)
+    if margin:
+        margin_re = re.compile(u'(?m)^' + margin)
+        head = [margin_re.sub(u'', piece) for piece in head]
 
-    sample = text[:80*1000]
+    sample = u''.join(head)[:REWRAP_SAMPLE_SIZE]
     if len([x for x in sample.split('\n') if x.startswith(' ')]) > 20:
         # Paragraphs separated by indent
-        text = re.sub(u'\n(?!\\s)', u' ', text)
+        join_re = _INDENT_JOIN_RE
     elif max(map(len, sample.split("\n"))) < 100 and sample.count('\n\n') > 5:
         # Paragraphs separated by empty lines
-        text = re.sub(u'\n(?!\n)', u' ', text)
+        join_re = _EMPTY_JOIN_RE
     else:
         # Paragraphs on a single line -- or couldn't determine formatting
-        pass
+        join_re = None
+
+    # Join lines, and collapse whitespace. Trailing whitespace is carried
+    # over to the next piece, so that no substitution spans two pieces.
+    carry = u''
+    for piece in itertools.chain(head, itertools.imap(_clean_piece, pieces)):
+        piece = carry + piece
+        end = len(piece.rstrip(_WHITESPACE))
+        carry = piece[end:]
+        if end > 0:
+            yield _rewrap_piece(piece[:end], join_re)
+    yield _rewrap_piece(carry, join_re)
+
+def _line_pieces(blocks):
+    """
+    Regroup blocks of text to pieces that end at line boundaries
+    """
+    rest = []
+    for block in blocks:
+        end = block.rfind(u'\n') + 1
+        if end == 0:
+            rest.append(block)
+            continue
+        rest.append(block[:end])
+        yield u''.join(rest)
+        rest = [block[end:]]
+    yield u''.join(rest)
+
+def _clean_piece(text):
+    """
+    Remove rulers and carriage returns, and empty whitespace-only lines
+    """
+    if u'----------' in text:
+        text = _DASH_LINE_RE.sub(u'', text)
+    if u'==========' in text:
+        text = _EQUALS_LINE_RE.sub(u'', text)
+    if u'\r' in text:
+        text = text.replace(u'\r', u'')
+    return _WHITESPACE_LINE_RE.sub(u'', text)
+
+def _rewrap_piece(text, join_re):
+    if join_re is not None:
+        text = join_re.sub(u' ', text)
+    text = _LONG_WHITESPACE_RE.sub(u'\n', text)
+    return _NEWLINE_INDENT_RE.sub(u'\n', text)
 
-    text = re.sub(u'\s{10,}', u'\n', text)
-    text = re.sub(u'\n[ \t]+', u'\n', text)
-    return text
+def _common_prefix(a, b):
+    if a is None:
+        return b
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return a[:i]
+    return a[:len(b)]
 
 if __name__ == "__main__":
     txt = EbookText('x.html')
@@ -7,7 +7,8 @@ import time
 import math
 
 from ui import *
-from model_text import EbookText, UnsupportedFormat
+from model_text import (EbookText, UnsupportedFormat, open_book,
+                        LARGE_BOOK_SIZE)
 
 class ReaderWindow(object):
     def __init__(self, app, textbuffer, filename):
@@ -42,13 +43,26 @@ class ReaderWindow(object):
         self.textscroll.connect("button-release-event",
                                 self.button_release_event)
 
-        # Scroll to saved position
-        it = textbuffer.get_iter_at_offset(pos)
+        # Load the text around the saved position first, and scroll to it
+        textbuffer.fill(pos, prepend_wrapper=self._keep_position)
+        it = textbuffer.get_iter_at_book_offset(pos)
         self.mark = textbuffer.create_mark("pos", it)
         self.textview.scroll_to_mark(self.mark, 0, use_align=True, yalign=0)
 
+    def _keep_position(self, insert):
+        """
+        Keep the topmost visible text in place while text is inserted
+        before it
+        """
+        rect = self.textview.get_visible_rect()
+        it = self.textview.get_iter_at_location(rect.x, rect.y)
+        self.textbuffer.move_mark(self.mark, it)
+        insert()
+        self.textview.scroll_to_mark(self.mark, 0, use_align=True, yalign=0)
+
     def on_destroy(self, ev):
         self._destroyed = True
+        self.textbuffer.stop_fill()
         try:
             self.app.readers.remove(self)
         except ValueError:
@@ -162,16 +176,25 @@ class ReaderWindow(object):
 
         rect = self.textview.get_visible_rect()
 
-        cpage = round(1 + rect.y / rect.height)
-        npages = round(1 + size[1] / rect.height)
+        # The buffer may hold only a part of the book
+        pages_per_char = (float(size[1]) / rect.height
+                          / max(1, self.textbuffer.get_char_count()))
+        cpage = round(1 + rect.y / rect.height
+                      + self.textbuffer.start * pages_per_char)
+        npages = round(1 + self.textbuffer.book.length * pages_per_char)
         self.info.set_text('%d / %d' % (cpage, npages))
 
         it = self.textview.get_iter_at_location(rect.x, rect.y)
 
         # Save position
-        self.app.config['positions'][self.filename] = it.get_offset()
+        self.app.config.set_entry('positions', self.filename,
+                                  self.textbuffer.get_book_offset(it))
+        self.app.config.save_later()
 
     def on_scrolled(self, adj):
+        rect = self.textview.get_visible_rect()
+        it = self.textview.get_iter_at_location(rect.x, rect.y)
+        self.textbuffer.move_window(self.textbuffer.get_book_offset(it))
         self._update_info_schedule.run_later_in_gui_thread(
             100, self._update_info)
 
@@ -245,18 +268,16 @@ def run(app, filename):
     notify_cb = app.show_notify(app.window.widget, _("Loading..."))
 
     @assert_gui_thread
-    def load_buffer_cb(textbuffer):
+    def load_book_cb(book):
         notify_cb()
         error = None
 
-        if isinstance(textbuffer, UnsupportedFormat):
+        if isinstance(book, UnsupportedFormat):
             error = run_fbreader(filename)
             if error is None:
                 return
-        elif isinstance(textbuffer, Exception):
-            error = str(textbuffer)
-        elif textbuffer.error:
-            error = textbuffer.error
+        elif isinstance(book, Exception):
+            error = str(book)
 
         title = os.path.splitext(os.path.basename(filename))[0]
         if error:
@@ -268,11 +289,19 @@ def run(app, filename):
             dlg.connect("response", lambda obj, ev: dlg.destroy())
             dlg.show()
         else:
+            window_sections = None
+            if book.length > LARGE_BOOK_SIZE:
+                window_sections = EbookText.WINDOW_SECTIONS
+            textbuffer = EbookText(filename, book=book, lazy=True,
+                                   window_sections=window_sections)
             reader = ReaderWindow(app, textbuffer, filename)
             reader.show_all()
             app.readers.append(reader)
 
-    run_in_background(EbookText, filename, callback=load_buffer_cb)
+    # Only parsing is done in the background; the buffer is filled in
+    # the GUI thread, starting from the saved position
+    run_in_background(open_book, filename, callback=load_book_cb,
+                      priority=PRIORITY_INTERACTIVE)
 
 @assert_gui_thread
 def run_fbreader(filename):
@@ -3,7 +3,13 @@ Utility tools
 
 """
 
+import os as _os
+import tempfile as _tempfile
 import urllib as _urllib
+import urlparse as _urlparse
+import httplib as _httplib
+import socket as _socket
+import threading as _threading
 
 class HTTPError(IOError):
     def __init__(self, code, msg, headers):
@@ -17,12 +23,266 @@ class MyURLOpener(_urllib.FancyURLopener):
         fp.close()
         raise HTTPError(errcode, errmsg, headers)   
 
+class ConnectionPool(object):
+    """
+    HTTP/1.1 client that keeps connections alive, and reuses them
+    for subsequent requests to the same host.
+
+    At most `max_idle` idle connections are kept per host. Socket
+    operations time out after `timeout` seconds.
+    """
+
+    max_redirects = 10
+
+    def __init__(self, max_idle=2, timeout=60):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = _threading.Lock()
+
+    def urlopen(self, url, data=None):
+        """
+        Open an http or https URL, following redirects
+
+        :Returns:
+            File-like object; closing it returns the connection to the pool.
+        """
+        for k in xrange(self.max_redirects):
+            response = self._request(url, data)
+            if response.status in (301, 302, 303, 307):
+                location = response.getheader('location')
+                response.read()
+                response.close()
+                if not location:
+                    raise HTTPError(response.status, response.reason,
+                                    response.info())
+                url = _urlparse.urljoin(url, location)
+                if response.status != 307:
+                    data = None
+            elif response.status >= 400:
+                response.close()
+                raise HTTPError(response.status, response.reason,
+                                response.info())
+            else:
+                return response
+        raise HTTPError(response.status, "Too many redirects",
+                        response.info())
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        self._lock.acquire()
+        try:
+            for conns in self._idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+    def _request(self, url, data):
+        scheme, netloc, path, query, fragment = _urlparse.urlsplit(url)
+        key = (scheme.lower(), netloc)
+        if not path:
+            path = '/'
+        if query:
+            path += '?' + query
+
+        headers = {'User-Agent': MyURLOpener.version}
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        while True:
+            # POSTs are not idempotent, so they are not retried, and are
+            # not sent on idle connections the server may have dropped
+            conn, reused = self._get_connection(key, reuse=(method == 'GET'))
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            except (_httplib.HTTPException, _socket.error), e:
+                conn.close()
+                if reused:
+                    # server may have dropped an idle connection; retry
+                    continue
+                if isinstance(e, IOError):
+                    raise
+                raise IOError('http error', str(e))
+            return _PooledResponse(self, key, conn, response, url)
+
+    def _get_connection(self, key, reuse=True):
+        if reuse:
+            self._lock.acquire()
+            try:
+                conns = self._idle.get(key)
+                if conns:
+                    return conns.pop(), True
+            finally:
+                self._lock.release()
+
+        scheme, netloc = key
+        if scheme == 'https':
+            cls = _httplib.HTTPSConnection
+        else:
+            cls = _httplib.HTTPConnection
+        try:
+            conn = cls(netloc, timeout=self.timeout)
+        except TypeError:
+            # Python 2.5: no timeout argument
+            conn = cls(netloc)
+        try:
+            if hasattr(conn, 'timeout'):
+                conn.connect()
+            else:
+                _connect_with_timeout(conn, self.timeout)
+        except _socket.error:
+            conn.close()
+            raise
+        return conn, False
+
+    def _release_connection(self, key, conn):
+        self._lock.acquire()
+        try:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+def _connect_with_timeout(conn, timeout):
+    """
+    Connect a Python 2.5 HTTP(S)Connection, timing out also the connect
+    """
+    msg = "getaddrinfo returns an empty list"
+    sock = None
+    for af, socktype, proto, canonname, sa in _socket.getaddrinfo(
+            conn.host, conn.port, 0, _socket.SOCK_STREAM):
+        try:
+            sock = _socket.socket(af, socktype, proto)
+            sock.settimeout(timeout)
+            sock.connect(sa)
+            break
+        except _socket.error, msg:
+            if sock is not None:
+                sock.close()
+            sock = None
+    if sock is None:
+        raise _socket.error, msg
+    if isinstance(conn, _httplib.HTTPSConnection):
+        ssl = _socket.ssl(sock, conn.key_file, conn.cert_file)
+        sock = _httplib.FakeSocket(sock, ssl)
+    conn.sock = sock
+
+class _PooledResponse(object):
+    """
+    File-like HTTP response, whose connection returns to the pool on close
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self._buf = ""
+
+    def read(self, size=None):
+        if size is None:
+            data = self._buf + self._read()
+            self._buf = ""
+        elif size <= len(self._buf):
+            data = self._buf[:size]
+            self._buf = self._buf[size:]
+        else:
+            data = self._buf + self._read(size - len(self._buf))
+            self._buf = ""
+        return data
+
+    def readline(self, size=None):
+        while '\n' not in self._buf:
+            if size is not None and len(self._buf) >= size:
+                break
+            block = self._read(8192)
+            if not block:
+                break
+            self._buf += block
+        end = self._buf.find('\n') + 1
+        if end == 0:
+            end = len(self._buf)
+        if size is not None:
+            end = min(end, size)
+        data = self._buf[:end]
+        self._buf = self._buf[end:]
+        return data
+
+    def _read(self, size=None):
+        try:
+            if size is None:
+                return self._response.read()
+            return self._response.read(size)
+        except (_httplib.HTTPException, _socket.error), e:
+            # the connection is in an unknown state: don't reuse it
+            conn = self._conn
+            self._conn = None
+            self._response.close()
+            if conn is not None:
+                conn.close()
+            if isinstance(e, IOError):
+                raise
+            raise IOError('http error', str(e))
+
+    def info(self):
+        return self._response.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        if self._response.isclosed() and not self._response.will_close:
+            # response fully read: connection can be reused
+            self._pool._release_connection(self._key, conn)
+        else:
+            self._response.close()
+            conn.close()
+
+_pool = ConnectionPool()
+
+def set_connection_pool(pool):
+    """
+    Use the given ConnectionPool in myurlopen
+    """
+    global _pool
+    _pool = pool
+
 _urlopener = None
 def myurlopen(url, data=None, proxies=None):
     """
     As urllib.urlopen, but raises HTTPErrors on HTTP failure
+
+    Plain HTTP(S) requests go through a pool of keep-alive connections,
+    unless a proxy is in use.
     """
     global _urlopener
+
+    scheme = url.split(':', 1)[0].lower()
+    if (proxies is None and scheme in ('http', 'https')
+            and scheme not in _urllib.getproxies()):
+        return _pool.urlopen(url, data)
+
     if proxies is not None:
         opener = MyURLOpener(proxies=proxies)
     elif not _urlopener:
@@ -59,4 +319,63 @@ def unique(s, key=None):
     
     return s2
 
-__all__ = ['myurlopen', 'unique']
+def memoize(max_entries=1024):
+    """
+    Cache return values of a function of hashable arguments [decorator]
+
+    At most `max_entries` values are kept; the cache is emptied when
+    it fills up. The undecorated function is available as ``func``.
+    """
+    def decorator(func):
+        cache = {}
+        def wrapper(*a):
+            try:
+                return cache[a]
+            except KeyError:
+                pass
+            if len(cache) >= max_entries:
+                cache.clear()
+            value = func(*a)
+            cache[a] = value
+            return value
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.func = func
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+def cache_file_name(name):
+    """
+    Return path to a file in the MGutenberg cache directory
+
+    The directory is created if it does not exist.
+    """
+    d = _os.path.join(_os.path.expanduser("~"), '.mgutenberg')
+    if not _os.path.isdir(d):
+        _os.makedirs(d)
+    return _os.path.join(d, name)
+
+def atomic_write(file_name, data):
+    """
+    Write data to a file, so that either the old or the new contents
+    survive if the process is killed in the middle.
+    """
+    fd, tmp_name = _tempfile.mkstemp(dir=_os.path.dirname(file_name),
+                                     prefix='.tmp-')
+    try:
+        f = _os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            _os.fsync(f.fileno())
+        finally:
+            f.close()
+        _os.rename(tmp_name, file_name)
+    except:
+        if _os.path.exists(tmp_name):
+            _os.unlink(tmp_name)
+        raise
+
+__all__ = ['myurlopen', 'unique', 'memoize', 'cache_file_name', 'atomic_write',
+           'ConnectionPool', 'set_connection_pool']
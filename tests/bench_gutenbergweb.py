@@ -0,0 +1,187 @@
+"""
+Benchmarks for Project Gutenberg page parsing.
+
+Run as ``python tests/bench_gutenbergweb.py``.
+"""
+import sys, os, time, re
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mgutenberg.gutenbergweb as gutenbergweb
+
+SEARCH_ROW = """<tr class="%(cls)s"> <td>%(etext)d</td> <td>%(info)s</td> <td>Nietzsche, Friedrich Wilhelm, 1844-1900 [Author]<br>Common, Thomas, 1850-1919 [Translator]</td> <td> <a href="/ebooks/%(etext)d">Thus Spake Zarathustra: A Book for All and None, part %(etext)d</a> </td> <td>English</td> </tr>"""
+
+def make_search_page(nrows):
+    """
+    Synthetic search result page, in the layout of the catalog result pages
+    """
+    head = ('<html><head><title>Search results</title></head><body>'
+            + '<div class="menu">' + 'x' * 2000 + '</div>'
+            + '<table class="pgdbfiles">')
+    rows = []
+    for j in xrange(nrows):
+        rows.append(SEARCH_ROW % dict(
+            cls=('odd', 'even')[j % 2], etext=1000 + j,
+            info=('', '<img src="/pics/stock_volume.png">')[j % 7 == 0]))
+    # long lines without newlines are the worst case for the old parser
+    return head + ' '.join(rows) + '</table></body></html>'
+
+_OLD_SEARCH_RE = re.compile(".*?" + gutenbergweb._GUTEN_SEARCH_RE_1.pattern,
+                            re.X | re.I)
+
+def old_parse_search_html(html):
+    """
+    The former slice-and-rescan parser, for comparison
+    """
+    _ = gutenbergweb._
+    _strip_tags = gutenbergweb._strip_tags
+    _parse_gutenberg_authors = gutenbergweb._parse_gutenberg_authors
+
+    entries = []
+    h = html
+    while h:
+        m = _OLD_SEARCH_RE.search(h)
+        if m:
+            h = h[m.end():]
+            g = m.groupdict()
+
+            try:
+                etext = int(g['etext'])
+            except (KeyError, ValueError):
+                continue
+
+            if 'stock_volume' in g.get('infocol', ''):
+                category = _(u'Audio book')
+            else:
+                category = u''
+
+            entries.append((
+                etext,
+                _parse_gutenberg_authors(unicode(_strip_tags(g.get('authors', '')), 'utf-8')),
+                unicode(_strip_tags(g.get('title', '')), 'utf-8'),
+                unicode(_strip_tags(g.get('language', '')), 'utf-8'),
+                category,
+                ))
+        else:
+            break
+    return entries
+
+INFO_HEAD = """<html><head><title>Thus Spake Zarathustra by Friedrich Wilhelm Nietzsche - Project Gutenberg</title></head>
+<body><div id="content">
+<h1>Bibliographic Record</h1>
+<table class="bibrec" summary="Bibliographic data of author and book.">
+<tr><th>Author</th><td><a href="/browse/authors/n#a779">Nietzsche, Friedrich Wilhelm, 1844-1900</a></td></tr>
+<tr><th>Title</th><td property="dcterms:title">Thus Spake Zarathustra</td></tr>
+<tr><th>Language</th><td property="dcterms:language">English</td></tr>
+<tr><th>Category</th><td property="dcterms:type" datatype="dcterms:DCMIType">Audio Book, computer-generated</td></tr>
+<tr><th>EText-No.</th><td>19634</td></tr>
+</table>
+<h2>Download this ebook for free</h2>
+<table class="files" summary="Table of available file types and sizes.">
+<tr><th>Format</th><th>Encoding</th><th>Compression</th><th>Size</th></tr>
+"""
+
+INFO_ROW = """<tr class="%(cls)s"><td><span class="flag"></span></td>
+<td property="dcterms:format" content="%(mime)s"><a href="/files/19634/%(fn)s" type="%(mime)s" class="link">%(descr)s</a></td>
+<td>%(size)d KB</td></tr>
+"""
+
+INFO_FORMATS = [
+    ('19634.txt', 'text/plain; charset=us-ascii', 'plain text us-ascii'),
+    ('19634.zip', 'application/zip', 'plain text us-ascii zipped'),
+    ('19634-h/19634-h.htm', 'text/html; charset=us-ascii', 'HTML us-ascii'),
+    ('19634-mp3/19634-01.mp3', 'audio/mpeg', 'MP3 audio'),
+]
+
+def make_info_page(nrows=len(INFO_FORMATS)):
+    """
+    Synthetic etext info page, in the layout of the ebook pages
+    """
+    rows = []
+    for j in xrange(nrows):
+        fn, mime, descr = INFO_FORMATS[j % len(INFO_FORMATS)]
+        if j >= len(INFO_FORMATS):
+            fn = fn.replace('19634', '19634-%d' % j, 1)
+        rows.append(INFO_ROW % dict(cls=('odd', 'even')[j % 2], fn=fn,
+                                    mime=mime, descr=descr, size=100 + j))
+    return (INFO_HEAD + ''.join(rows) + '</table>\n'
+            + '<p>The <a href="/cache/plucker/19634/19634">Plucker</a> '
+            + 'version may be out of date.</p></div></body></html>')
+
+_OLD_ETEXT_RE_0 = re.compile("""
+<td[^>]*dcterms:type[^>]*>(?P<category>.*?)</td>
+""", re.X | re.I)
+
+_OLD_ETEXT_RE_1 = re.compile('''
+.*?
+  <td[^>]*dcterms:format[^>]*>
+    \s*
+    <a.*\s+href="(?P<url>[^"]*)"[^>]*>(?P<description>[^>]*)</a>
+''', re.X | re.I)
+
+def old_parse_ebook_html(etext, html):
+    """
+    The former two-regex, slice-and-rescan parser, for comparison
+    """
+    _strip_tags = gutenbergweb._strip_tags
+
+    entries = []
+    if '/cache/plucker' in html:
+        entries.append((gutenbergweb._PLUCKER_URL % dict(etext=etext),
+                        'plucker'))
+
+    category = u''
+    h = html
+    m = _OLD_ETEXT_RE_0.search(h)
+    if m:
+        category = unicode(_strip_tags(m.group('category').strip()), 'utf-8')
+
+    while h:
+        m = _OLD_ETEXT_RE_1.search(h)
+        if m:
+            h = h[m.end():]
+            g = m.groupdict()
+            url = g.get('url', '').strip()
+            description = unicode(_strip_tags(g.get('description', '')).strip(),
+                                  'utf-8')
+            if url:
+                if url.startswith('/'):
+                    url = gutenbergweb._DOWNLOAD_URL_BASE + url
+                entries.append((url, description))
+        else:
+            break
+
+    return entries, dict(category=category)
+
+def timeit(func, *a):
+    best = None
+    for k in range(3):
+        start = time.time()
+        r = func(*a)
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best, r
+
+def bench_search(nrows=1000):
+    html = make_search_page(nrows)
+    t_old, r_old = timeit(old_parse_search_html, html)
+    t_new, r_new = timeit(gutenbergweb._parse_gutenberg_search_html, html)
+    assert r_old == r_new
+    print "search page, %d rows (%d kB):" % (nrows, len(html) // 1024)
+    print "    old %.3f s, new %.3f s, speedup %.1fx" % (
+        t_old, t_new, t_old / max(t_new, 1e-6))
+
+def bench_info(nrows=100):
+    html = make_info_page(nrows)
+    t_old, r_old = timeit(old_parse_ebook_html, 19634, html)
+    t_new, r_new = timeit(gutenbergweb._parse_gutenberg_ebook_html, 19634, html)
+    assert r_old == r_new
+    print "info page, %d formats (%d kB):" % (nrows, len(html) // 1024)
+    print "    old %.4f s, new %.4f s, speedup %.1fx" % (
+        t_old, t_new, t_old / max(t_new, 1e-6))
+
+if __name__ == "__main__":
+    for n in (100, 1000, 5000):
+        bench_search(n)
+    for n in (4, 100, 1000):
+        bench_info(n)
@@ -0,0 +1,255 @@
+"""
+Benchmarks for ebook data models.
+
+Run as ``python tests/bench_model.py``.
+"""
+import sys, os, re, time, random, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mgutenberg.model as model
+
+AUTHORS = [
+    [(u'Dickens, Charles', u'', u'1812-1870', u'author')],
+    [(u'Twain, Mark', u'Samuel Langhorne Clemens', u'1835-1910', u'author')],
+    [(u'Nietzsche, Friedrich Wilhelm', u'', u'1844-1900', u'author'),
+     (u'Common, Thomas', u'', u'1850-1919', u'translator')],
+    [(u'Doyle, Arthur Conan', u'', u'1859-1930', u'author'),
+     (u'Paget, Sidney', u'', u'1860-1908', u'illustrator')],
+    [(u'Verne, Jules', u'', u'1828-1905', u'author')],
+]
+
+TITLES = [u'The Adventures of Tom Sawyer, Part %d',
+          u'A Tale of Two Cities -- Volume %d',
+          u'Thus Spake Zarathustra: A Book for All and None %d',
+          u'An Inquiry into the Nature of Things %d',
+          u'The Hound of the Baskervilles %d']
+
+def make_rows(nrows, ntitles=200):
+    random.seed(1234)
+    return [(random.choice(AUTHORS),
+             random.choice(TITLES) % random.randint(1, ntitles))
+            for j in xrange(nrows)]
+
+def format_rows(rows, format_authors, format_title):
+    for authors, title in rows:
+        format_authors(tuple(authors))
+        format_title(title)
+
+def bench_format(nrows=3000):
+    rows = make_rows(nrows)
+
+    def uncached_title(title):
+        return model.ellipsize(model.transpose_articles(title), max_length=80)
+
+    start = time.time()
+    format_rows(rows, model.format_authors.func, uncached_title)
+    t_old = time.time() - start
+
+    model.format_authors.cache.clear()
+    model.format_title.cache.clear()
+    start = time.time()
+    format_rows(rows, model.format_authors, model.format_title)
+    t_cold = time.time() - start
+
+    start = time.time()
+    format_rows(rows, model.format_authors, model.format_title)
+    t_warm = time.time() - start
+
+    print "formatting %d rows:" % nrows
+    print "    uncached %.1f us/row, memoized %.1f us/row (cold), " \
+          "%.1f us/row (warm)" % (1e6*t_old/nrows, 1e6*t_cold/nrows,
+                                  1e6*t_warm/nrows)
+
+def make_tree(base, nfiles=50000, files_per_dir=100):
+    """
+    Synthetic library: author directories with book files in them
+    """
+    for j in xrange(nfiles // files_per_dir):
+        d = os.path.join(base, 'Author%d, Some' % j)
+        os.makedirs(d)
+        for k in xrange(files_per_dir):
+            open(os.path.join(d, 'Book number %d [en].txt' % k), 'w').close()
+
+def old_walk_tree(files, d, author_name=""):
+    """
+    The former recursive walker, for comparison
+    """
+    if not os.path.isdir(d):
+        return
+    try:
+        paths = os.listdir(d)
+    except OSError:
+        return
+    for path in paths:
+        full_path = os.path.join(d, path)
+        if os.path.isdir(full_path):
+            was_author = (',' in author_name)
+            if not author_name or not was_author:
+                old_walk_tree(files, full_path, path)
+            else:
+                old_walk_tree(files, full_path, author_name)
+        else:
+            entry = model.parse_book_file_name(path, full_path, author_name)
+            if entry is not None:
+                files.append(entry)
+
+GUTENBERG_NAMES = [
+    '%(auth)s - %(titl)s [%(lang)s]%(ext)s',
+    '%(auth)s - %(titl)s%(ext)s',
+    '%(titl)s [%(lang)s]%(ext)s',
+    '%(titl)s%(ext)s',
+    'pg%(num)d%(ext)s',
+    '%(num)d-8%(ext)s',
+    '%(num)d-h%(ext)s',
+    '%(num)d-0%(ext)s',
+]
+
+GUTENBERG_EXTS = ['.txt', '.txt.utf8', '.txt.gz', '.htm', '.html.bz2',
+                  '.zip', '.fb2.zip', '.pdb', '.mobi', '.tar.gz', '.mp3',
+                  '.ogg', '.jpg', '.doc', '']
+
+def make_file_names(nnames=100000):
+    """
+    File names in the styles found in Project Gutenberg downloads
+    """
+    random.seed(1234)
+    authors = [a[0][0].encode('utf-8') for a in AUTHORS]
+    authors.append('Dickens, Charles; Collins, Wilkie')
+    titles = [t.encode('utf-8') for t in TITLES]
+    names = []
+    for j in xrange(nnames):
+        num = random.randint(1, 40000)
+        names.append(random.choice(GUTENBERG_NAMES) % dict(
+            auth=random.choice(authors),
+            titl=random.choice(titles) % num,
+            lang=random.choice(['en', 'de', 'fi', 'English']),
+            num=num,
+            ext=random.choice(GUTENBERG_EXTS)))
+    return names
+
+OLD_VALID_EXT = ['.txt', '.html', '.htm', '.fb2', '.chm', '.rtf', '.oeb',
+                 '.zip', '.prc', '.pdb', '.mobi', '.orb', '.opf', '.oebzip',
+                 '.tcr', '.tgz', '.ipk']
+OLD_SKIP_EXT = ['.gz', '.bz2', '.tar', '.utf8', '.ascii', '.gen']
+OLD_FILE_RES = [
+    re.compile(r"^(?P<auth>[^-\[\]]+) - (?P<titl>[^\[\]]+) \[(?P<lang>.*)\]$"),
+    re.compile(r"^(?P<auth>[^-]+) - (?P<titl>.+)$"),
+    re.compile(r"^(?P<titl>[^\[\]]+) \[(?P<lang>.+)\]$"),
+    re.compile(r"^(?P<titl>.+)$")
+]
+
+def old_parse_book_file_name(path, full_path, author_name=""):
+    """
+    The former file name parser, for comparison
+    """
+    base = path
+    while True:
+        base, ext = os.path.splitext(base)
+        if ext in OLD_VALID_EXT:
+            break
+        elif ext in OLD_SKIP_EXT:
+            pass
+        else:
+            return None
+
+    for reg in OLD_FILE_RES:
+        m = reg.match(base)
+        if m:
+            g = m.groupdict()
+            return (g.get('auth', author_name).replace("; ", "\n"),
+                    g.get('titl', base).replace("; ", "\n"),
+                    g.get('lang', ''),
+                    full_path)
+    return (author_name, base, "", full_path)
+
+def bench_classify(nnames=100000):
+    names = make_file_names(nnames)
+
+    start = time.time()
+    old = [old_parse_book_file_name(x, x, 'Someone') for x in names]
+    t_old = time.time() - start
+
+    start = time.time()
+    new = [model.parse_book_file_name(x, x, 'Someone') for x in names]
+    t_new = time.time() - start
+
+    assert old == new
+
+    print "classifying %d file names:" % nnames
+    print "    old %.2f us/name, new %.2f us/name" % (1e6*t_old/nnames,
+                                                     1e6*t_new/nnames)
+
+def bench_walk(nfiles=50000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        books = os.path.join(tmpdir, 'Books')
+        make_tree(books, nfiles)
+        index_file = os.path.join(tmpdir, 'index')
+
+        start = time.time()
+        files = []
+        old_walk_tree(files, books)
+        t_old = time.time() - start
+
+        results = []
+        for n_threads in (1, 4):
+            index = model.LibraryIndex(None, n_threads=n_threads)
+            start = time.time()
+            new_files = index.scan([books])
+            results.append(time.time() - start)
+            assert sorted(new_files) == sorted(files)
+
+        # warm persistent index: pretend the tree was not modified recently
+        index = model.LibraryIndex(index_file)
+        index.MTIME_SLACK = -1e9
+        index.scan([books])
+        index = model.LibraryIndex(index_file)
+        index.MTIME_SLACK = -1e9
+        start = time.time()
+        index.scan([books])
+        t_warm = time.time() - start
+
+        print "walking %d files (scandir %s):" % (
+            nfiles, model._scandir is not None and "available" or "missing")
+        print "    old %.2f s, new %.2f s (1 thread), %.2f s (4 threads), " \
+              "%.2f s (warm index)" % (t_old, results[0], results[1], t_warm)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_config(npositions=5000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        schema = {'positions': (dict, int), 'recent_files': (dict, int),
+                  'search_dirs': (list, str)}
+        config = model.Config(schema, os.path.join(tmpdir, 'config'),
+                              os.path.join(tmpdir, 'mgutenbergrc'))
+        config['positions'] = {}
+        config['recent_files'] = {}
+        for j in xrange(npositions):
+            fn = '/home/user/MyDocs/Books/Author %d/Book %d [en].txt' % (j, j)
+            config['positions'][fn] = j * 1000
+            config['recent_files'][fn] = 1200000000 + j
+        config['search_dirs'] = ['/home/user/MyDocs/Books']
+
+        times = []
+        for save, load in ((config.save_xml, config._load_xml),
+                           (config.save, config.load)):
+            start = time.time()
+            save()
+            t_save = time.time() - start
+            start = time.time()
+            load()
+            times.append((t_save, time.time() - start))
+        assert len(config['positions']) == npositions
+
+        print "config with %d positions:" % npositions
+        print "    XML save %.3f s, load %.3f s; " \
+              "marshal save %.3f s, load %.3f s" % (times[0] + times[1])
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    bench_format(3000)
+    bench_classify(100000)
+    bench_walk(50000)
+    bench_config(5000)
@@ -0,0 +1,83 @@
+"""
+Benchmarks for ebook text loading.
+
+Run as ``python tests/bench_model_text.py``.
+"""
+import sys, os, time, random, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mgutenberg.model_text as model_text
+from test_model_text import _old_rewrap
+
+WORDS = ['the', 'adventures', 'of', 'a', 'gentleman', 'who', 'walked',
+         'through', 'London', 'at', 'night', 'and', 'saw', 'nothing',
+         'remarkable', 'except', 'himself']
+
+def make_html_book(file_name, nparas=20000):
+    random.seed(1234)
+    f = open(file_name, 'w')
+    f.write('<html><body>\n')
+    for j in xrange(nparas):
+        if j % 500 == 0:
+            f.write('<h2>Chapter %d</h2>\n' % (j // 500 + 1))
+        words = [random.choice(WORDS) for k in xrange(random.randint(5, 80))]
+        words[3] = '<i>%s</i>' % words[3]
+        f.write('<p>%s</p>\n' % ' '.join(words))
+    f.write('</body></html>\n')
+    f.close()
+
+def read_all(book):
+    for k in xrange(book.section_count):
+        book.read_section(k)
+
+def bench_open(nparas=20000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(tmpdir, 'book.html')
+        make_html_book(file_name, nparas)
+        cache = model_text.BookCache(os.path.join(tmpdir, 'cache'))
+        model_text.set_book_cache(cache)
+
+        start = time.time()
+        book = model_text.open_book(file_name)
+        read_all(book)
+        t_cold = time.time() - start
+
+        start = time.time()
+        book = model_text.open_book(file_name)
+        read_all(book)
+        t_warm = time.time() - start
+
+        print "opening a %.1f MB HTML book (%d characters):" % (
+            os.path.getsize(file_name) / 1e6, book.length)
+        print "    cold %.3f s, warm (cached) %.3f s" % (t_cold, t_warm)
+    finally:
+        model_text.set_book_cache(None)
+        shutil.rmtree(tmpdir)
+
+def make_plain_text(nparas=20000):
+    random.seed(1234)
+    paras = []
+    for j in xrange(nparas):
+        words = [random.choice(WORDS) for k in xrange(random.randint(5, 80))]
+        lines = [' '.join(words[k:k+10]) for k in xrange(0, len(words), 10)]
+        paras.append('\n'.join(lines))
+    return unicode('\n\n'.join(paras))
+
+def bench_rewrap(nparas=20000):
+    text = make_plain_text(nparas)
+    start = time.time()
+    expected = _old_rewrap(text)
+    t_old = time.time() - start
+
+    start = time.time()
+    result = model_text.rewrap(text)
+    t_new = time.time() - start
+
+    assert result == expected
+    print "rewrapping %d characters of plain text:" % len(text)
+    print "    old %.3f s, new %.3f s" % (t_old, t_new)
+
+if __name__ == "__main__":
+    bench_open(20000)
+    bench_rewrap(20000)
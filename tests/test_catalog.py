@@ -0,0 +1,94 @@
+import os, tempfile, shutil
+import mgutenberg.catalog as catalog
+
+RDF = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE rdf:RDF [
+  <!ENTITY pg "Project Gutenberg">
+  <!ENTITY f "http://www.gutenberg.org/dirs/">
+]>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:dc="http://purl.org/dc/elements/1.1/"
+         xmlns:dcterms="http://purl.org/dc/terms/"
+         xmlns:pgterms="http://www.gutenberg.org/rdfterms/">
+<pgterms:etext rdf:ID="etext1998">
+  <dc:publisher>&pg;</dc:publisher>
+  <dc:title rdf:parseType="Literal">Thus Spake Zarathustra</dc:title>
+  <dc:creator rdf:parseType="Literal">Nietzsche, Friedrich Wilhelm, 1844-1900</dc:creator>
+  <dc:contributor rdf:parseType="Literal">Common, Thomas, 1850-1919 [Translator]</dc:contributor>
+  <dc:subject><dcterms:LCSH><rdf:value>Philosophy, German</rdf:value></dcterms:LCSH></dc:subject>
+  <dc:language><dcterms:ISO639-2><rdf:value>en</rdf:value></dcterms:ISO639-2></dc:language>
+</pgterms:etext>
+<pgterms:file rdf:about="&f;1/9/9/1998/1998.txt">
+  <dc:format><dcterms:IMT><rdf:value>text/plain; charset="us-ascii"</rdf:value></dcterms:IMT></dc:format>
+  <dcterms:isFormatOf rdf:resource="#etext1998" />
+</pgterms:file>
+<pgterms:file rdf:about="&f;1/9/9/1998/1998.zip">
+  <dc:format><dcterms:IMT><rdf:value>text/plain; charset="us-ascii"</rdf:value></dcterms:IMT></dc:format>
+  <dc:format><dcterms:IMT><rdf:value>application/zip</rdf:value></dcterms:IMT></dc:format>
+  <dcterms:isFormatOf rdf:resource="#etext1998" />
+</pgterms:file>
+<pgterms:etext rdf:ID="etext7205">
+  <dc:title rdf:parseType="Literal">Also sprach Zarathustra</dc:title>
+  <dc:creator><rdf:Bag><rdf:li rdf:parseType="Literal">Nietzsche, Friedrich Wilhelm, 1844-1900</rdf:li></rdf:Bag></dc:creator>
+  <dc:language><dcterms:ISO639-2><rdf:value>de</rdf:value></dcterms:ISO639-2></dc:language>
+</pgterms:etext>
+<pgterms:etext rdf:ID="etext100">
+  <dc:title rdf:parseType="Literal">Moby Dick</dc:title>
+  <dc:creator rdf:parseType="Literal">Melville, Herman, 1819-1891</dc:creator>
+  <dc:language><dcterms:ISO639-2><rdf:value>en</rdf:value></dcterms:ISO639-2></dc:language>
+  <dc:type><dcterms:DCMIType><rdf:value>Sound</rdf:value></dcterms:DCMIType></dc:type>
+</pgterms:etext>
+</rdf:RDF>
+"""
+
+def _make_catalog(tmpdir):
+    dump = os.path.join(tmpdir, 'catalog.rdf')
+    index = os.path.join(tmpdir, 'catalog')
+    f = open(dump, 'w')
+    f.write(RDF)
+    f.close()
+    assert catalog.build_catalog(dump, index) == 3
+    return catalog.Catalog(index)
+
+def test_search():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cat = _make_catalog(tmpdir)
+
+        r = cat.search(author=u'nietzsche')
+        assert [eid for eid,au,tt,lng,c in r] == [7205, 1998], r
+        assert all(isinstance(tt, unicode) and isinstance(lng, unicode)
+                   for eid,au,tt,lng,c in r), r
+
+        eid, au, tt, lng, c = cat.search(title=u'thus zarath')[0]
+        assert eid == 1998
+        assert tt == u'Thus Spake Zarathustra'
+        assert lng == u'English'
+        assert au == [(u'Nietzsche, Friedrich Wilhelm', u'', u'1844-1900',
+                       u'author'),
+                      (u'Common, Thomas', u'', u'1850-1919', u'translator')], au
+
+        assert cat.search(author=u'nietzsche', title=u'moby') == []
+        assert [x[0] for x in cat.search(subject=u'philosophy')] == [1998]
+        assert [x[0] for x in cat.search(etextnr=100)] == [100]
+        assert cat.search(etextnr=100)[0][4] == u'Audio book'
+        assert cat.search(author=u'nietzsche', pageno=1) == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_info():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cat = _make_catalog(tmpdir)
+        r, infodict = cat.etext_info(1998)
+        assert r == [
+            ('http://www.gutenberg.org/dirs/1/9/9/1998/1998.txt',
+             u'plain text us-ascii'),
+            ('http://www.gutenberg.org/dirs/1/9/9/1998/1998.zip',
+             u'plain text us-ascii zipped')], r
+        assert infodict['category'] == u'Text'
+        r, infodict = cat.etext_info(100)
+        assert r == []
+        assert 'audio book' in infodict['category'].lower()
+    finally:
+        shutil.rmtree(tmpdir)
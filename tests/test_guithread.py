@@ -0,0 +1,136 @@
+import threading
+
+import mgutenberg.guithread as guithread
+from mgutenberg.guithread import (WorkerPool, PRIORITY_INTERACTIVE,
+                                  PRIORITY_NORMAL, PRIORITY_BACKGROUND)
+
+def _wait_for(cond):
+    for j in xrange(500):
+        if cond():
+            return
+        threading.Event().wait(0.01)
+    assert False, "timed out"
+
+def _block(pool, priority=PRIORITY_INTERACTIVE):
+    """
+    Occupy a worker until the returned event is set
+    """
+    started = threading.Event()
+    release = threading.Event()
+    def run():
+        started.set()
+        release.wait(5)
+    pool.submit(run, priority=priority)
+    started.wait(5)
+    assert started.isSet()
+    return release
+
+class _GuiCalls(object):
+    """
+    Collect calls to run_in_gui_thread, to be run by `run_all`
+    """
+    def __init__(self):
+        self.calls = []
+        self._orig = guithread.run_in_gui_thread
+        guithread.run_in_gui_thread = self._add
+
+    def _add(self, func, *a, **kw):
+        self.calls.append((func, a, kw))
+
+    def run_all(self):
+        while self.calls:
+            func, a, kw = self.calls.pop(0)
+            func(*a, **kw)
+
+    def restore(self):
+        guithread.run_in_gui_thread = self._orig
+
+def test_priority_order():
+    pool = WorkerPool(max_workers=1)
+    done = []
+    release = _block(pool)
+    for priority in (PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE,
+                     PRIORITY_NORMAL, PRIORITY_INTERACTIVE):
+        pool.submit(done.append, (priority,), priority=priority)
+    release.set()
+    _wait_for(lambda: len(done) == 4)
+    assert done == [PRIORITY_INTERACTIVE, PRIORITY_INTERACTIVE,
+                    PRIORITY_NORMAL, PRIORITY_BACKGROUND], done
+
+def test_worker_cap():
+    pool = WorkerPool(max_workers=3)
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+    release = threading.Event()
+    done = []
+    def run():
+        lock.acquire()
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        lock.release()
+        release.wait(5)
+        lock.acquire()
+        running[0] -= 1
+        lock.release()
+        done.append(1)
+    for j in xrange(5):
+        pool.submit(run, priority=PRIORITY_BACKGROUND)
+    _wait_for(lambda: running[0] == 2)
+
+    # One worker stays free for interactive work
+    interactive = threading.Event()
+    pool.submit(interactive.set, priority=PRIORITY_INTERACTIVE)
+    interactive.wait(5)
+    assert interactive.isSet()
+    assert running[0] == 2
+
+    release.set()
+    _wait_for(lambda: len(done) == 5)
+    assert peak[0] == 2, peak
+    assert pool._workers <= pool.max_workers
+
+def test_cancel():
+    gui = _GuiCalls()
+    try:
+        pool = WorkerPool(max_workers=1)
+        results = []
+
+        # Cancelled before starting: not run
+        release = _block(pool)
+        ran = []
+        task = pool.submit(ran.append, (1,), callback=results.append)
+        task.cancel()
+        release.set()
+        _wait_for(lambda: not pool._queue)
+        pool.submit(ran.append, (2,))
+        _wait_for(lambda: ran == [2])
+
+        # Cancelled while running: no callback
+        started = threading.Event()
+        release = threading.Event()
+        def run():
+            started.set()
+            release.wait(5)
+            return 'late'
+        task = pool.submit(run, callback=results.append)
+        started.wait(5)
+        task.cancel()
+        release.set()
+
+        # Cancelled after finishing, but before the callback ran
+        finished = []
+        task = pool.submit(lambda: 'value', callback=results.append)
+        pool.submit(finished.append, (1,))
+        _wait_for(lambda: finished)
+        task.cancel()
+
+        # Not cancelled
+        task = pool.submit(lambda: 'ok', callback=results.append)
+        pool.submit(finished.append, (2,))
+        _wait_for(lambda: len(finished) == 2)
+
+        gui.run_all()
+        assert results == ['ok'], results
+    finally:
+        gui.restore()
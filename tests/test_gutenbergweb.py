@@ -54,3 +54,82 @@ def test_authors():
     assert authors == [(u'Cobb, Irvin S.', u'', u'-1944', u'author'),
                        (u'Sarg, Tony', '', u'', u'illustrator')], \
                        authors
+
+def test_search_cache():
+    import os, tempfile, shutil, time
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'cache')
+        cache = gutenbergweb.SearchCache(fn, max_entries=2, ttl=100)
+        assert cache.get('a') is None
+        cache.put('a', [1])
+        cache.put('b', [])
+        assert cache.get('a') == [1]
+        assert cache.get('b') == []
+
+        # persistence
+        cache = gutenbergweb.SearchCache(fn, max_entries=2, ttl=100)
+        assert cache.get('b') == []
+        time.sleep(0.01)
+        assert cache.get('a') == [1]
+
+        # LRU eviction: 'b' was used least recently
+        cache.put('c', [3])
+        assert cache.get('b') is None
+        assert cache.get('a') == [1]
+        assert cache.get('c') == [3]
+
+        # use times are saved: 'a' was added first, but used last
+        cache = gutenbergweb.SearchCache(fn, max_entries=2, ttl=100)
+        time.sleep(0.01)
+        assert cache.get('a') == [1]
+        cache = gutenbergweb.SearchCache(fn, max_entries=2, ttl=100)
+        cache.put('d', [4])
+        assert cache.get('c') is None
+        assert cache.get('a') == [1]
+
+        # results are copied
+        value = cache.get('a')
+        value.append(5)
+        assert cache.get('a') == [1]
+        value = [6]
+        cache.put('e', value)
+        value.append(7)
+        assert cache.get('e') == [6]
+
+        # expiry
+        cache.ttl = -1
+        assert cache.get('a') is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_parse_search_html():
+    import bench_gutenbergweb
+    html = bench_gutenbergweb.make_search_page(20)
+    r = gutenbergweb._parse_gutenberg_search_html(html)
+    assert [eid for eid,au,tt,lng,c in r] == range(1000, 1020), r
+    eid, au, tt, lng, c = r[0]
+    assert au == [(u'Nietzsche, Friedrich Wilhelm', u'', u'1844-1900',
+                   u'author'),
+                  (u'Common, Thomas', u'', u'1850-1919', u'translator')], au
+    assert tt == u'Thus Spake Zarathustra: A Book for All and None, part 1000'
+    assert lng == u'English'
+    assert c == u'Audio book'
+    assert r[1][4] == u''
+
+def test_parse_ebook_html():
+    import bench_gutenbergweb
+    html = bench_gutenbergweb.make_info_page()
+    r, infodict = gutenbergweb._parse_gutenberg_ebook_html(19634, html)
+    assert r == [
+        ('http://www.gutenberg.org/cache/plucker/19634/19634', 'plucker'),
+        ('http://www.gutenberg.org/files/19634/19634.txt',
+         u'plain text us-ascii'),
+        ('http://www.gutenberg.org/files/19634/19634.zip',
+         u'plain text us-ascii zipped'),
+        ('http://www.gutenberg.org/files/19634/19634-h/19634-h.htm',
+         u'HTML us-ascii'),
+        ('http://www.gutenberg.org/files/19634/19634-mp3/19634-01.mp3',
+         u'MP3 audio')], r
+    assert infodict['category'] == u'Audio Book, computer-generated'
+    assert r == bench_gutenbergweb.old_parse_ebook_html(19634, html)[0]
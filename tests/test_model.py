@@ -4,3 +4,277 @@ def test_transpose_articles():
     for s in [u',', u' --', u'\u2015']:
         assert (model.transpose_articles(u"The Adventures Sawyer%s Part 1"%s)
                                         == u"Adventures Sawyer, The%s Part 1"%s)
+
+def _touch(*parts):
+    import os
+    fn = os.path.join(*parts)
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    open(fn, 'w').close()
+    return fn
+
+def test_library_index():
+    import os, tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        books = os.path.join(tmpdir, 'Books')
+        fn1 = _touch(books, 'Twain, Mark', 'Tom Sawyer [en].txt')
+        fn2 = _touch(books, 'Doyle, Arthur - The Hound [en].txt.gz')
+        _touch(books, 'notes.doc')
+        index_file = os.path.join(tmpdir, 'index')
+
+        index = model.LibraryIndex(index_file)
+        files = sorted(index.scan([books]))
+        assert files == [('Doyle, Arthur', 'The Hound', 'en', fn2),
+                         ('Twain, Mark', 'Tom Sawyer', 'en', fn1)], files
+
+        # Unchanged directories are not listed again
+        index = model.LibraryIndex(index_file)
+        index._dirs = index._load()
+        for d, item in index._dirs.items():
+            index._dirs[d] = (os.stat(d).st_mtime,) + item[1:3] + ([],)
+        list_dir = model._list_dir
+        try:
+            model._list_dir = None
+            assert index.scan([books]) == [files[0]]
+        finally:
+            model._list_dir = list_dir
+
+        # Changed directories are
+        index = model.LibraryIndex(index_file)
+        fn3 = _touch(books, 'Twain, Mark', 'Huckleberry Finn.txt')
+        files = sorted(index.scan([books]))
+        assert files[1] == ('Twain, Mark', 'Huckleberry Finn', '', fn3), files
+        assert len(files) == 3
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_library_index_rescan():
+    import os, tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        books = os.path.join(tmpdir, 'Books')
+        twain = os.path.join(books, 'Twain, Mark')
+        fn1 = _touch(twain, 'Tom Sawyer [en].txt')
+        fn2 = _touch(books, 'Doyle, Arthur', 'Sherlock', 'The Hound.txt')
+        index = model.LibraryIndex(os.path.join(tmpdir, 'index'))
+        index.scan([books])
+
+        fn3 = _touch(books, 'Verne, Jules - Mathias Sandorf.txt')
+        fn4 = _touch(books, 'Poe, Edgar', 'Tales', 'The Raven.txt')
+        shutil.rmtree(twain)
+
+        # Only the changed directory and the new ones are listed
+        listed = []
+        list_dir = model._list_dir
+        def log_list_dir(d):
+            listed.append(d)
+            return list_dir(d)
+        try:
+            model._list_dir = log_list_dir
+            removed, added = index.rescan([books, twain,
+                                           os.path.join(tmpdir, 'other')])
+        finally:
+            model._list_dir = list_dir
+        assert sorted(listed) == [books, os.path.join(books, 'Poe, Edgar'),
+                                  os.path.join(books, 'Poe, Edgar', 'Tales')]
+        assert removed == [('Twain, Mark', 'Tom Sawyer', 'en', fn1)], removed
+        assert sorted(added) == [('Poe, Edgar', 'The Raven', '', fn4),
+                                 ('Verne, Jules', 'Mathias Sandorf', '', fn3)]
+
+        # The index is up to date
+        files = sorted(model.LibraryIndex().scan([books]))
+        assert sorted(index.scan([books])) == files
+        assert index.rescan([books]) == ([], [])
+
+        # Paths are normalized
+        index.scan([books + os.sep])
+        fn5 = _touch(books, 'Verne, Jules', 'Around the World.txt')
+        removed, added = index.rescan([os.path.join(books, 'x', '..')])
+        assert added == [('Verne, Jules', 'Around the World', '', fn5)]
+        files = sorted(files + added)
+
+        # Removed directories are dropped with their subdirectories
+        shutil.rmtree(books)
+        removed, added = index.rescan([books])
+        assert sorted(removed) == files and added == [], removed
+        assert index._dirs == {}
+    finally:
+        shutil.rmtree(tmpdir)
+
+class _Task(object):
+    def cancel(self):
+        pass
+
+def test_search_list_prefetch():
+    gui_calls = []
+    searches = []
+    def run_in_background(func, *a, **kw):
+        searches.append(kw)
+        return _Task()
+    orig = model.run_in_gui_thread, model.run_in_background
+    model.run_in_gui_thread = lambda func, *a: gui_calls.append((func, a))
+    model.run_in_background = run_in_background
+    try:
+        results = model.GutenbergSearchList(prefetch_pages=1)
+        results.new_search(author='x')
+        searches.pop(0)['callback']([])
+        prefetch = searches.pop(0)
+        assert prefetch['pageno'] == 1
+        prefetch['callback']([])
+
+        # A prefetched page is not shown after a new search
+        done = []
+        results.next_page(callback=done.append)
+        results.new_search(author='y')
+        for func, a in gui_calls:
+            func(*a)
+        del gui_calls[:]
+        assert results.pageno == 0 and done == []
+
+        # ... but is otherwise
+        searches.pop(0)['callback']([])
+        searches.pop(0)['callback']([])
+        results.next_page(callback=done.append)
+        for func, a in gui_calls:
+            func(*a)
+        assert results.pageno == 1 and done == [True]
+    finally:
+        model.run_in_gui_thread, model.run_in_background = orig
+
+def test_search_index():
+    index = model.SearchIndex()
+    index.add('a', u'Bront\xeb, EmilyWuthering Heightsen')
+    index.add('b', 'Twain, MarkTom Sawyeren')
+    index.add('c', u'Twain, MarkHuckleberry Finnen')
+    assert index.search([u'bronte']) == set(['a'])
+    assert index.search([u'BRONT\xcb', 'height']) == set(['a'])
+    assert index.search(['twain', 'saw']) == set(['b'])
+    assert index.search(['en']) == set(['a', 'b', 'c'])
+    assert index.search(['n']) == set(['a', 'b', 'c'])
+    assert index.search(['twain', 'zz']) == set()
+    assert index.search(['mark'], candidates=set(['a', 'c'])) == set(['c'])
+    assert index.matches('b', ['tom'])
+    index.remove('b')
+    assert index.search(['twain']) == set(['c'])
+    assert not index.matches('b', ['tom'])
+    index.add('c', 'Doyle, ArthurThe Houndsen')
+    assert index.search(['twain']) == set()
+    assert index.search(['hound']) == set(['c'])
+
+def test_classify_file_name():
+    for name, expected in [
+            ('Twain, Mark - Tom Sawyer [en].txt',
+             ('Twain, Mark', 'Tom Sawyer', 'en')),
+            ('Twain, Mark - Tom Sawyer.txt.utf8.gz',
+             ('Twain, Mark', 'Tom Sawyer', '')),
+            ('Tom Sawyer [en].fb2.zip', (None, 'Tom Sawyer [en].fb2', '')),
+            ('Tom Sawyer [en].txt', (None, 'Tom Sawyer', 'en')),
+            ('..txt', None),
+            ('Tom - Sawyer [1].htm', ('Tom', 'Sawyer', '1')),
+            ('Tom - Sawyer - Part 1.htm', ('Tom', 'Sawyer - Part 1', '')),
+            ('pg74.txt', (None, 'pg74', '')),
+            ('.txt', None),
+            ('pg74.mp3', None),
+            ('pg74.gz', None)]:
+        assert model.classify_file_name(name) == expected, name
+
+    assert model.parse_book_file_name('Tom Sawyer [en].txt', '/x',
+                                      'Twain, Mark') == (
+        'Twain, Mark', 'Tom Sawyer', 'en', '/x')
+
+def test_config():
+    import os, tempfile, shutil, marshal
+    tmpdir = tempfile.mkdtemp()
+    try:
+        schema = {'positions': (dict, int), 'search_dirs': (list, str),
+                  'portrait': bool}
+        file_name = os.path.join(tmpdir, 'config')
+        xml_file_name = os.path.join(tmpdir, 'mgutenbergrc')
+
+        config = model.Config(schema, file_name, xml_file_name)
+        try:
+            config.load()
+            assert False
+        except IOError:
+            pass
+
+        # Migration from XML
+        config.update(positions={'/a.txt': 10}, search_dirs=['/books'],
+                      portrait=True, bogus=1)
+        config.save_xml()
+        config = model.Config(schema, file_name, xml_file_name)
+        config.load()
+        assert config == dict(positions={'/a.txt': 10},
+                              search_dirs=['/books'], portrait=True), config
+        assert os.path.isfile(file_name)
+
+        config['positions']['/b.txt'] = 20
+        config.save()
+        config = model.Config(schema, file_name, xml_file_name)
+        config.load()
+        assert config['positions'] == {'/a.txt': 10, '/b.txt': 20}
+
+        # Unrecognized files are moved aside, and the XML file is used
+        for data in ['garbage',
+                     marshal.dumps((model.Config.FORMAT, 99, 1, {}))]:
+            open(file_name, 'wb').write(data)
+            config = model.Config(schema, file_name, xml_file_name)
+            config.load()
+            assert config == dict(positions={'/a.txt': 10},
+                                  search_dirs=['/books'], portrait=True)
+            assert open(file_name + '.old', 'rb').read() == data
+            config = model.Config(schema, file_name, xml_file_name)
+            config.load()
+            assert config['positions'] == {'/a.txt': 10}
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_config_journal():
+    import os, tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        schema = {'positions': (dict, int), 'portrait': bool}
+        file_name = os.path.join(tmpdir, 'config')
+        xml_file_name = os.path.join(tmpdir, 'mgutenbergrc')
+
+        config = model.Config(schema, file_name, xml_file_name)
+        config['positions'] = {'/a.txt': 10, '/b.txt': 20}
+        config.save()
+
+        config.set_entry('positions', '/a.txt', 0)
+        config['portrait'] = True
+        del config['positions']['/b.txt']
+        config.mark_dirty('positions', '/b.txt')
+        config.save_changes()
+        size = os.path.getsize(config.journal_file_name)
+        config.save_changes()
+        assert os.path.getsize(config.journal_file_name) == size
+
+        config.set_entry('positions', '/c.txt', 30)
+        config.save_changes()
+
+        # A record cut short by a crash is ignored
+        f = open(config.journal_file_name, 'ab')
+        f.write(model._journal_record(('positions', '/d.txt', True, 40))[:-2])
+        f.close()
+
+        loaded = model.Config(schema, file_name, xml_file_name)
+        loaded.load()
+        assert loaded == dict(positions={'/a.txt': 0, '/c.txt': 30},
+                              portrait=True), loaded
+
+        # A full save starts a new journal
+        loaded.save()
+        assert not os.path.exists(loaded.journal_file_name)
+
+        # The journal of a previous save is not replayed
+        f = open(config.journal_file_name, 'wb')
+        f.write(model._journal_record((model.Config.FORMAT, 1)))
+        f.write(model._journal_record(('portrait', None, True, False)))
+        f.close()
+        loaded = model.Config(schema, file_name, xml_file_name)
+        loaded.load()
+        assert loaded['portrait'] is True
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,208 @@
+import os, tempfile, shutil, re, random, textwrap
+
+import mgutenberg.model_text as model_text
+
+def test_parse_html():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'book.html')
+        f = open(fn, 'w')
+        f.write("<html><body><h2>Title</h2>"
+                "<p>Some <b>bold <i>and</i></b> text</p></body></html>")
+        f.close()
+
+        book = model_text.parse_book(fn)
+        assert book.text == u"\n\nTitle\n\nSome bold and text", book.text
+        assert book.runs == [(2, 7, ('big',)), (14, 19, ('bold',)),
+                             (19, 22, ('bold', 'emph'))], book.runs
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_runs_between():
+    book = model_text.ParsedBook(u"x" * 30, [(0, 5, ('bold',)),
+                                             (10, 20, ('emph',)),
+                                             (25, 30, ('big',))])
+    assert book.runs_between(0, 30) == book.runs
+    assert book.runs_between(3, 12) == [(3, 5, ('bold',)),
+                                        (10, 12, ('emph',))]
+    assert book.runs_between(12, 15) == [(12, 15, ('emph',))]
+    assert book.runs_between(20, 25) == []
+
+def test_parser_insert():
+    parser = model_text._BookParser()
+    parser._append(u"Hello ", ['bold'])
+    parser._append(u"world")
+    parser._insert(3, u"XX", ['emph'])
+    parser._insert(0, u"<")
+    parser._insert(100, u">")
+    assert u"".join(parser._pieces) == u"<HelXXlo world>"
+    assert parser._piece_tags == [(), ('bold',), ('emph',), ('bold',), (),
+                                  ()]
+
+def test_sections():
+    text = u"".join([u"Line %d of the text\n" % j for j in xrange(5000)])
+    heading = text.index(u"Line 1500 ")
+    book = model_text.ParsedBook(text, [(heading, heading + 9, ('big',))])
+
+    boundaries = book.boundaries
+    assert boundaries[0] == 0 and boundaries[-1] == len(text)
+    assert heading in boundaries
+    for a, b in zip(boundaries, boundaries[1:]):
+        assert 0 < b - a <= model_text.SECTION_SIZE + 1000
+        assert text[b-1] == u"\n"
+    assert book.section_at(heading) == boundaries.index(heading)
+    assert book.section_at(len(text)) == book.section_count - 1
+
+    empty = model_text.ParsedBook(u"", [])
+    assert empty.boundaries == [0, 0] and empty.read_section(0) == (u"", [])
+
+def test_paged_book():
+    text = u"".join([u"\xe4 line %d\n" % j for j in xrange(20000)])
+    runs = [(j, j + 3, ('bold',)) for j in xrange(0, len(text), 1000)]
+    book = model_text.ParsedBook(text, runs)
+    paged = model_text.PagedBook.create(book)
+    try:
+        assert paged.boundaries == book.boundaries
+        assert paged.length == len(text)
+        for k in range(paged.section_count) + [0, 3]:
+            assert paged.read_section(k) == book.read_section(k), k
+    finally:
+        paged.close()
+
+def test_book_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'book.txt')
+        f = open(fn, 'w')
+        f.write("Some text.\n" * 1000)
+        f.close()
+        cache = model_text.BookCache(os.path.join(tmpdir, 'cache'),
+                                     max_size=100000)
+        assert cache.get(fn) is None
+
+        book = model_text.parse_book(fn)
+        cached = cache.put(fn, book)
+        assert cached.read_section(0) == book.read_section(0)
+        cached.close()
+
+        cached = cache.get(fn)
+        assert cached.boundaries == book.boundaries
+        assert cached.read_section(0) == book.read_section(0)
+        cached.close()
+
+        # Changed files are not taken from the cache
+        f = open(fn, 'a')
+        f.write("More text.\n")
+        f.close()
+        assert cache.get(fn) is None
+
+        # Least recently used entries are evicted
+        cache.max_size = 1
+        cache.put(fn, model_text.parse_book(fn)).close()
+        assert len(os.listdir(cache.directory)) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_rewrap():
+    assert model_text.rewrap(u"") is None
+    # Paragraphs on single lines; margins and rulers are removed
+    assert model_text.rewrap(
+        u"  Para one\n  goes on.\n\n  Para two\n  ----------\n  ends.\r\n"
+        ) == u"Para one\ngoes on.\n\nPara two\n\nends.\n"
+    # Paragraphs separated by empty lines
+    text = u"".join([u"Para %d\ngoes on.\n\n" % j for j in xrange(6)])
+    assert model_text.rewrap(text) == u"".join(
+        [u"Para %d goes on.\n" % j for j in xrange(6)])
+    # Paragraphs separated by indent
+    text = u"a\n" + u"\n".join([u"   Para %d\nnext" % j for j in xrange(21)])
+    assert model_text.rewrap(text) == u"a" + u"".join(
+        [u"\nPara %d next" % j for j in xrange(21)])
+    # Long whitespace runs become a newline
+    assert model_text.rewrap(u"Line one\nline two\n" + u"\n" * 12 + u"after"
+                             ) == u"Line one line two\nafter"
+
+def test_rewrap_blocks():
+    # The result does not depend on how the text is split into blocks,
+    # though the style and the margin are known only after the sample
+    text = u"".join([u"  Para %d\n  goes on.\n\n" % j for j in xrange(20000)])
+    expected = u"".join([u"Para %d goes on.\n" % j for j in xrange(20000)])
+    for size in (7, 1000, len(text)):
+        blocks = [text[j:j+size] for j in xrange(0, len(text), size)]
+        assert u"".join(model_text.rewrap_blocks(blocks)) == expected, size
+
+def _old_rewrap(text, sample_size=80*1000):
+    """
+    The former whole-text implementation of rewrap, for reference
+    """
+    if not text:
+        return
+    text = re.sub(r'-{10,}', '', text)
+    text = re.sub(r'={10,}', '', text)
+    text = text.replace(u'\r', u'')
+    text = textwrap.dedent(text)
+    sample = text[:sample_size]
+    if len([x for x in sample.split('\n') if x.startswith(' ')]) > 20:
+        text = re.sub(u'\n(?!\\s)', u' ', text)
+    elif max(map(len, sample.split("\n"))) < 100 and sample.count('\n\n') > 5:
+        text = re.sub(u'\n(?!\n)', u' ', text)
+    text = re.sub(u'\s{10,}', u'\n', text)
+    text = re.sub(u'\n[ \t]+', u'\n', text)
+    return text
+
+def _rewrap_corpus(count):
+    rnd = random.Random(1234)
+    words = [u'word', u'x', u'-' * 12, u'=' * 11, u'a\rb', u'  ', u'\t']
+    for j in xrange(count):
+        margin = rnd.choice([u'', u'  ', u'\t', u' \t'])
+        style = rnd.choice(['indent', 'empty', 'single'])
+        lines = []
+        for k in xrange(rnd.randint(0, 100)):
+            line = u' '.join([rnd.choice(words)
+                              for w in xrange(rnd.randint(0, 20))])
+            if style == 'indent' and rnd.random() < 0.3:
+                line = u'   ' + line
+            lines.append(margin + line)
+            if style == 'empty' and rnd.random() < 0.4:
+                lines.append(rnd.choice([u'', u' ', margin]))
+            if rnd.random() < 0.05:
+                lines.extend([u''] * rnd.randint(1, 12))
+            if rnd.random() < 0.05:
+                lines.append(u' ' * rnd.randint(1, 15))
+        yield u'\n'.join(lines) + rnd.choice([u'', u'\n'])
+
+def test_rewrap_reference():
+    # Same output as the former implementation, also when blocks split
+    # lines, paragraphs and the style sample
+    sample_size = model_text.REWRAP_SAMPLE_SIZE
+    try:
+        for sample in (sample_size, 37, 1000):
+            model_text.REWRAP_SAMPLE_SIZE = sample
+            for text in _rewrap_corpus(150):
+                expected = _old_rewrap(text, sample)
+                if not text:
+                    assert model_text.rewrap(text) == expected
+                    continue
+                for size in (1, 7, 50, 1000, len(text)):
+                    blocks = [text[j:j+size]
+                              for j in xrange(0, len(text), size)]
+                    result = u"".join(model_text.rewrap_blocks(blocks))
+                    assert result == expected, (sample, size, text)
+    finally:
+        model_text.REWRAP_SAMPLE_SIZE = sample_size
+
+def test_decode_blocks():
+    def decode(blocks):
+        return u"".join(model_text.decode_blocks(blocks))
+    # UTF-8 sequences may be split between blocks
+    text = u"\xe9t\xe9 \u2019" * 10
+    data = text.encode('utf-8')
+    assert decode([data[j:j+3] for j in xrange(0, len(data), 3)]) == text
+    assert decode([data[:-1]]) == text[:-1] + u"\xe2\x80"
+    assert decode([]) == u""
+    # Other encodings, also when detected only midway
+    assert decode(["\xe9t\xe9 ", "it\x92s"]) == u"\xe9t\xe9 it\u2019s"
+    assert decode(["ok ", "\xe9t\xe9 ", "ok ", "it\x92s"]
+                  ) == u"ok \xe9t\xe9 ok it\u2019s"
+    assert decode(["it\x92s ", "\xe9t\xe9"]) == u"it\u2019s \xe9t\xe9"
+    assert decode(["caf\xc3\xa9 ", "caf\xe9 ", "\xc3\xa9"]
+                  ) == u"caf\xe9 caf\xe9 \xc3\xa9"
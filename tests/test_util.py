@@ -0,0 +1,155 @@
+import threading
+import httplib
+import SocketServer
+import BaseHTTPServer
+
+import mgutenberg.util as util
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/page?x=1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/page'):
+            body = 'page %s' % self.path
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/lines':
+            body = 'one\ntwo\n\nthree'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/truncated':
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write('short')
+            self.close_connection = 1
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def do_POST(self):
+        self.server.clients.add(self.client_address)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *a):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def _start_server():
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.clients = set()
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+def test_connection_pool():
+    server, base = _start_server()
+    pool = util.ConnectionPool(max_idle=1, timeout=10)
+    try:
+        for k in range(5):
+            h = pool.urlopen(base + '/page%d' % k)
+            assert h.read() == 'page /page%d' % k
+            h.close()
+
+        # one connection served everything
+        assert len(server.clients) == 1, server.clients
+        conn = pool._idle.values()[0][0]
+        assert conn.sock.gettimeout() == 10
+
+        h = pool.urlopen(base + '/redirect')
+        assert h.read() == 'page /page?x=1'
+        assert h.geturl() == base + '/page?x=1'
+        h.close()
+
+        try:
+            pool.urlopen(base + '/missing')
+            assert False
+        except util.HTTPError, e:
+            assert e.args[1] == 404
+        assert len(server.clients) == 1, server.clients
+
+        # POSTs are not sent on idle connections
+        h = pool.urlopen(base + '/page')
+        h.read()
+        h.close()
+        assert len(pool._idle.values()[0]) == 1
+        h = pool.urlopen(base + '/post', 'x=1')
+        assert h.read() == 'x=1'
+        h.close()
+        assert len(server.clients) == 3, server.clients
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+def test_pooled_response():
+    server, base = _start_server()
+    pool = util.ConnectionPool(timeout=10)
+    try:
+        h = pool.urlopen(base + '/lines')
+        assert h.readline() == 'one\n'
+        assert h.read(2) == 'tw'
+        assert h.readline(1) == 'o'
+        assert h.readline() == '\n'
+        assert h.readline() == '\n'
+        assert h.readline() == 'three'
+        assert h.readline() == ''
+        h.close()
+        assert len(pool._idle.values()[0]) == 1
+
+        # Errors while reading are IOErrors, and the connection is dropped
+        h = pool.urlopen(base + '/truncated')
+        try:
+            h.read()
+            assert False
+        except IOError:
+            pass
+        h.close()
+        assert pool._idle.values()[0] == []
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+def test_connect_with_timeout():
+    server, base = _start_server()
+    try:
+        conn = httplib.HTTPConnection(base[len('http://'):])
+        util._connect_with_timeout(conn, 5)
+        assert conn.sock.gettimeout() == 5
+        conn.request('GET', '/page')
+        assert conn.getresponse().read() == 'page /page'
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_memoize():
+    calls = []
+    def f(x):
+        calls.append(x)
+        return x * 2
+    g = util.memoize(max_entries=2)(f)
+    assert [g(1), g(1), g(2), g(1)] == [2, 2, 4, 2]
+    assert calls == [1, 2]
+    g(3)
+    assert len(g.cache) <= 2
+    assert g.func is f